@@ -5,21 +5,27 @@ st.set_page_config(page_title="ReceiptGuard AI", page_icon="🧾", layout="wide"
 
 import requests
 import json
-import base64
 import time
 import os
 import glob
+import tempfile
 from datetime import datetime
-from PIL import Image
-from io import BytesIO
 import re
 try:
     import pandas as pd
 except ImportError:
     pd = None
+from history_store import HISTORY_DIR, save_record, search_records, find_duplicates, sync_index, set_review
+from receipt_image import ReceiptImage
+from image_preflight import preflight
+from model_manager import OllamaModelManager
+from history_export import export_history, count_undated
+from receipt_guard import parse_model_output, raw_output_of, usage_stats_of, run_cascade, cascade_stats, CASCADE_FAST_MODEL, run_ocr_first
+from ocr_prepass import OCR_TEXT_MODEL, ocr_available, pipeline_report
+from prompts import PROMPTS, DEFAULT_PROMPT_VERSION, AB_VARIANTS, CHAT_SYSTEM_PROMPT, get_prompt, choose_prompt_version, ab_report
 
 # Configuration
-OLLAMA_API_BASE = "http://localhost:11434"
+OLLAMA_API_BASE = os.getenv("OLLAMA_API_BASE", "http://localhost:11434")
 OLLAMA_CHAT_URL = f"{OLLAMA_API_BASE}/api/chat"
 OLLAMA_TAGS_URL = f"{OLLAMA_API_BASE}/api/tags"
 
@@ -31,11 +37,24 @@ except (KeyError, FileNotFoundError):
     TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY", "tgp_v1_H9J4-xD4_n5_N8AUGiFpwkLpanweZuGjhy1ONQtblTI")
 
 TOGETHER_API_URL = "https://api.together.xyz/v1/chat/completions"
-HISTORY_DIR = "receipt_history"
 
 if not os.path.exists(HISTORY_DIR):
     os.makedirs(HISTORY_DIR)
 
+@st.cache_resource
+def init_history_index():
+    # Catch up on records written outside the app once per server process; save_record keeps it current after that
+    return sync_index()
+
+init_history_index()
+
+@st.cache_resource
+def get_model_manager():
+    # One manager per server process: every session shares the same Ollama instance
+    return OllamaModelManager(OLLAMA_API_BASE)
+
+model_manager = get_model_manager()
+
 st.title("🧾 ReceiptGuard AI")
 
 # Sidebar
@@ -61,32 +80,106 @@ with st.sidebar:
         available_models = ["llava-phi3", "qwen2.5-vl:3b"]
     
     model_name = st.selectbox("Select Vision Model", available_models, index=0)
+
+    # Warm the selected model in the background so the first analysis doesn't pay the cold load
+    if st.session_state.get('warmed_model') != model_name:
+        model_manager.preload(model_name)
+        st.session_state.warmed_model = model_name
+    if model_manager.is_local(model_name):
+        resident = model_manager.resident()
+        if model_manager.is_loading(model_name):
+            st.caption(f"⏳ Loading {model_name} into memory...")
+        elif resident:
+            st.caption("🔥 In memory: " + ", ".join(f"{m} ({size / 1024 ** 3:.1f} GB)" for m, size in resident.items()))
     if st.button("Refresh Models"):
         st.rerun()
 
+    # Prompt version (or A/B split between the compact and full prompt)
+    prompt_options = list(PROMPTS) + ["ab"]
+    prompt_mode = st.selectbox(
+        "Audit Prompt",
+        prompt_options,
+        index=prompt_options.index(DEFAULT_PROMPT_VERSION),
+        format_func=lambda v: f"A/B split ({AB_VARIANTS[0]} vs {AB_VARIANTS[1]})" if v == "ab" else f"{v} - {PROMPTS[v]['description']}"
+    )
+    ab_ratio = 0.5
+    if prompt_mode == "ab":
+        ab_ratio = st.slider(f"Share sent to {AB_VARIANTS[0]}", 0.0, 1.0, 0.5, 0.05)
+
+    # Cascade: small model first, the selected model only when needed
+    cascade_on = st.checkbox("⚡ Cascade mode", help="Run a fast model first and escalate to the selected model only on JSON failure, missing fields, a fraud verdict or low confidence.")
+    cascade_fast_model = None
+    if cascade_on:
+        cascade_fast_model = st.selectbox(
+            "First-pass model",
+            available_models,
+            index=available_models.index(CASCADE_FAST_MODEL) if CASCADE_FAST_MODEL in available_models else 0
+        )
+        st.caption(f"Escalates to **{model_name}**")
+
+    # OCR text pass: Tesseract + text-only model, vision model only as fallback
+    ocr_on = st.checkbox(
+        "📝 OCR text pass",
+        disabled=cascade_on or not ocr_available(),
+        help="Read the receipt with local OCR and audit the text with a fast text-only model; "
+             "falls back to the selected vision model when OCR confidence is low or the answer looks wrong. "
+             + ("" if ocr_available() else "Needs Tesseract and pytesseract installed.")
+    ) and not cascade_on
+    ocr_text_model = None
+    if ocr_on:
+        ocr_text_model = st.selectbox(
+            "Text model",
+            available_models,
+            index=available_models.index(OCR_TEXT_MODEL) if OCR_TEXT_MODEL in available_models else 0
+        )
+        st.caption(f"Falls back to **{model_name}**")
+
     st.divider()
     
     # History Section
     st.header("📜 History")
     
-    # Load history files - sorted by modification time (newest first)
-    history_files = sorted(glob.glob(f"{HISTORY_DIR}/*.json"), key=os.path.getmtime, reverse=True)
-    
     if st.button("➕ New Analysis", type="primary"):
-        for key in ['uploaded_file_id', 'image_base64', 'analysis_result', 'chat_history', 'usage_stats', 'current_file_path', 'timings']:
+        for key in ['uploaded_file_id', 'receipt_image', 'preflight', 'analysis_result', 'chat_history', 'usage_stats', 'current_file_path', 'timings']:
             if key in st.session_state:
                 del st.session_state[key]
         st.rerun()
 
-    st.caption("Select a past record:")
-    for fpath in history_files:
-        fname = os.path.basename(fpath).replace(".json", "")
-        # fname format: YYYYMMDD_HHMMSS_Merchant
-        display_name = fname.split("_", 2)[-1] if "_" in fname else fname
+    search_text = st.text_input("🔎 Search history", placeholder="Merchant, receipt no, address, notes...")
+    with st.expander("Filters", expanded=False):
+        fc1, fc2 = st.columns(2)
+        min_amount = fc1.number_input("Min RM", min_value=0.0, value=0.0, step=10.0)
+        max_amount = fc2.number_input("Max RM (0 = any)", min_value=0.0, value=0.0, step=10.0)
+        use_dates = st.checkbox("Filter by receipt date")
+        if use_dates:
+            date_from = fc1.date_input("From", value=None)
+            date_to = fc2.date_input("To", value=None)
+        else:
+            date_from = date_to = None
+
+    # Newest first, served from the history index rather than a folder scan
+    history_hits = search_records(
+        search_text,
+        min_amount=min_amount or None,
+        max_amount=max_amount or None,
+        date_from=date_from,
+        date_to=date_to,
+        limit=50
+    )
+
+    st.caption("Select a past record:" if history_hits else "No matching records.")
+    for hit in history_hits:
+        fpath = hit['path']
+        display_name = hit['merchant_name'] or os.path.basename(fpath).replace(".json", "")
+        if hit['amount'] is not None:
+            display_name += f" · RM {hit['amount']:.2f}"
+        if hit['receipt_date']:
+            display_name += f" · {hit['receipt_date']}"
         if st.button(f"📄 {display_name}", key=fpath):
             with open(fpath, "r") as f:
                 record = json.load(f)
-                st.session_state.image_base64 = record['image_base64']
+                st.session_state.receipt_image = ReceiptImage.from_base64(record['image_base64'], source=fpath)
+                st.session_state.pop('preflight', None)
                 st.session_state.analysis_result = record['analysis_result']
                 st.session_state.chat_history = record['chat_history']
                 st.session_state.usage_stats = record.get('usage_stats', {})
@@ -94,141 +187,18 @@ with st.sidebar:
                 st.session_state.current_file_path = fpath
                 st.rerun()
 
-def save_record(merchant, image_base64, analysis_result, chat_history, stats, timings, existing_filename=None):
-    if existing_filename:
-        filename = existing_filename
-        timestamp = datetime.now().strftime("%d-%m-%y-%H%M") # Updated modify time
-    else:
-        # Format: DD-MM-YY-HHMM-Merchant
-        timestamp = datetime.now().strftime("%d-%m-%y-%H%M")
-        safe_merchant = "".join([c for c in merchant if c.isalnum() or c in (' ', '_')]).strip().replace(" ", "_")
-        filename = f"{timestamp}-{safe_merchant}.json"
-    
-    filepath = os.path.join(HISTORY_DIR, filename)
-    
-    record = {
-        "timestamp": timestamp,
-        "merchant": merchant,
-        "image_base64": image_base64,
-        "analysis_result": analysis_result,
-        "chat_history": chat_history,
-        "usage_stats": stats,
-        "timings": timings
-    }
-    
-    with open(filepath, "w") as f:
-        json.dump(record, f, indent=2)
-    return filepath
-
-def analyze_receipt_api(image_base64, model):
-    system_prompt = """
-### SYSTEM RESET PROTOCOL
-You are a stateless auditor. You must IGNORE all previous receipt data, conversation history, or cached context. Analyze ONLY the image/text provided in this current transaction.
-
-### ROLE DEFINITION
-You are "Zhenyu + Yanzer Receipt AI," a specialized forensic document auditor and data extraction engine.
-**Your Mission:** Extract accurate receipt metadata AND detect fraud/tampering using strict Malaysian financial logic.
-
----
-
-### PART 1: KNOWLEDGE BASE (THE 11 RULES OF MALAYSIAN RECEIPTS)
-To validate this receipt, you must apply these strict rules. If any rule is broken, you must flag it in the validation result.
-
-1.  **Subtotal:** Sum of all visible Line Items.
-2.  **Service Charge (10%):** This is a tip for the staff, NOT a government tax.
-    * *Calculation:* It is calculated on the **Subtotal**.
-3.  **SST (Service Tax - 6% or 8%):**
-    * *F&B Standard:* Restaurants typically charge **6%**.
-    * *Other Services:* Professional/Digital services may charge **8%**.
-    * *Calculation Rule:* SST is strictly calculated on the **Subtotal** (the taxable service amount). It is **NOT** calculated on the Service Charge.
-    * *Warning:* Do not flag a receipt as "Wrong Math" if the tax is lower than expected because it didn't tax the service charge.
-4.  **Tax Exemptions:** Basic food items (Rice, Cooking Oil) may be 0% Tax, while processed items are 6-10%. A mix is valid.
-5.  **Rounding Adjustment:** A final discrepancy of **+/- RM 0.04** is LEGALLY VALID in Malaysia (5-cent rounding mechanism).
-6.  **Set Meals:** Items priced RM 0.00 are valid if part of a Combo/Set.
-7.  **Void Items:** Ignore lines marked "Void" or "Cancel".
-8.  **Discounts:** Can apply to specific items or the full Subtotal.
-9.  **Deposits:** Differentiate "Grand Total" (Spend) from "Balance Due" (Payment).
-10. **Unit Logic:** `Qty` x `Unit Price` MUST equal `Line Total`.
-11. **Footer Noise:** Ignore Credit Card terminal numbers/Auth codes.
-
----
-
-### PART 2: AUDIT PROTOCOL (THE "SCRATCHPAD" METHOD)
-*You must output this text block FIRST. Do not skip it. This is your "Working Memory".*
-
-**STEP 1: ITEM-BY-ITEM PRICE & MATH FORENSICS**
-Iterate through EVERY line item and output:
-* **Math Check:** Does `Qty` x `Price` = `Total`?
-* **Market Reason:** Does this specific price make sense in Malaysia?
-    * *Example:* "Teh O Ais at RM 150.00? -> REASON: Impossible, standard is RM 2-5."
-    * *Example:* "Wagyu Steak at RM 300.00? -> REASON: Plausible for premium beef."
-
-**STEP 2: TAX & TOTALS VERIFICATION (The "SST Logic Check")**
-* **Check Service Charge:** Is it 10% of Subtotal?
-* **Check SST:** Is it 6% (or 8%) of Subtotal?
-* **Final Math:** Subtotal + Svc Charge + SST +/- Rounding = Grand Total.
-* *Note:* If the math works but the rate is weird (e.g. 7%), flag as "SUSPICIOUS_TAX_RATE".
-
-**STEP 3: FRAUD VERDICT**
-* If Math fails > RM 0.05 diff (after rounding) => **FRAUD**.
-* If Price is impossible (e.g., RM 1000 Rice) => **FRAUD**.
-
----
-
-### PART 3: DATA EXTRACTION INSTRUCTIONS
-After the analysis, extract these specific fields into the JSON:
-
-1.  **merchant_name**: Dominant business name on header.
-2.  **receipt_no**: Unique transaction ID (Invoice/Ref/Bill). Ignore Credit Card/App Codes.
-3.  **amount**: The final Grand Total (number with decimal).
-4.  **receipt_date**: Format YYYY-MM-DD.
-5.  **location**: Full merchant address.
-
----
-
-### PART 4: FINAL OUTPUT FORMAT
-(Output the **AUDITOR SCRATCHPAD** text block first, then the **JSON** object).
-
-**Example Output Layout:**
-
-### AUDITOR SCRATCHPAD
-1. **Item Analysis:**
-   - [Item Name] | Qty: [x] | Unit: [Price] | Total: [LineTotal]
-     -> Math Status: [MATCH / FAIL]
-     -> Price Logic: [REASONING]
-   ...
-2. **Tax & Totals Review:**
-   - Subtotal: [RM xxx]
-   - Service Charge (10%): [RM xxx] (Calc on Subtotal)
-   - SST (6%): [RM xxx] (Calc on Subtotal)
-   - Rounding: [RM xxx]
-   - Expected Grand Total: [RM xxx] vs Printed: [RM xxx]
-3. **Verdict:** [VALID / FRAUD]
-
-```json
-{
-  "extracted_data": {
-    "merchant_name": "String",
-    "receipt_no": "String",
-    "amount": "String",
-    "receipt_date": "YYYY-MM-DD",
-    "location": "String"
-  },
-  "validation_result": {
-    "reasoning": "String",  // Summarize the Scratchpad findings here.
-    "conclusion": "String"  // "Yes" (if modified/fraud) OR "No" (if valid)
-  }
-}
-    """
+def analyze_receipt_api(image_base64, model, prompt_version=DEFAULT_PROMPT_VERSION):
+    prompt = get_prompt(prompt_version)
     payload = {
         "model": model,
         # "format": "json", # Removed to allow Scratchpad text
         "stream": False,
         "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": "Analyze this receipt.", "images": [image_base64]}
+            {"role": "system", "content": prompt['system']},
+            {"role": "user", "content": prompt['user'], "images": [image_base64]}
         ],
-        "options": {"temperature": 0.1}
+        "options": {"temperature": prompt['temperature'], "num_ctx": prompt['num_ctx']},
+        "keep_alive": model_manager.keep_alive
     }
     
     # Handle Together AI
@@ -239,11 +209,11 @@ After the analysis, extract these specific fields into the JSON:
             "Content-Type": "application/json"
         }
         messages = [
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": prompt['system']},
             {
                 "role": "user", 
                 "content": [
-                    {"type": "text", "text": "Analyze this receipt according to the system prompt."},
+                    {"type": "text", "text": prompt['user']},
                     {
                         "type": "image_url", 
                         "image_url": {
@@ -258,7 +228,7 @@ After the analysis, extract these specific fields into the JSON:
         payload = {
             "model": real_model,
             "messages": messages,
-            "temperature": 0.1,
+            "temperature": prompt['temperature'],
             "max_tokens": 4096,
             "stream": False
         }
@@ -285,7 +255,7 @@ After the analysis, extract these specific fields into the JSON:
 
 def chat_api(history, new_question, image_base64, model):
     # Prepare messages
-    messages = [{"role": "system", "content": "You are a helpful assistant analyzing a receipt. Be concise."}]
+    messages = [{"role": "system", "content": CHAT_SYSTEM_PROMPT}]
     for msg in history:
         messages.append({"role": msg["role"], "content": msg["content"]})
     
@@ -319,7 +289,7 @@ def chat_api(history, new_question, image_base64, model):
     else:
         # Ollama
         messages.append({"role": "user", "content": new_question, "images": [image_base64]})
-        payload = {"model": model, "stream": True, "messages": messages}
+        payload = {"model": model, "stream": True, "messages": messages, "keep_alive": model_manager.keep_alive}
         return requests.post(OLLAMA_CHAT_URL, json=payload, stream=True)
 
 # Main UI
@@ -344,16 +314,36 @@ with col1:
         # User just uploaded a file
         if 'uploaded_file_id' not in st.session_state or st.session_state.uploaded_file_id != uploaded_file.file_id:
             # New upload: reset everything
-            st.session_state.image_base64 = base64.b64encode(uploaded_file.getvalue()).decode('utf-8')
+            try:
+                st.session_state.receipt_image = ReceiptImage.from_bytes(uploaded_file.getvalue(), source=uploaded_file.name)
+            except ValueError as e:
+                st.error(f"❌ {e}")
+                st.stop()
             st.session_state.uploaded_file_id = uploaded_file.file_id
             for key in ['analysis_result', 'chat_history', 'usage_stats', 'timings', 'current_file_path']:
                 if key in st.session_state: del st.session_state[key]
+            # Local quality gate, once per upload (tens of ms) - catches unusable photos before a slow model call
+            st.session_state.preflight = preflight(st.session_state.receipt_image.to_bytes())
             
-    if 'image_base64' in st.session_state:
-        image = Image.open(BytesIO(base64.b64decode(st.session_state.image_base64)))
-        st.image(image, caption='Receipt Image', use_column_width=True)
+    if 'receipt_image' in st.session_state:
+        # Raw bytes go straight to the browser; no decode/re-encode on rerun
+        st.image(st.session_state.receipt_image.to_bytes(), caption='Receipt Image', use_column_width=True)
+        st.caption(f"🧠 Image held in session: {st.session_state.receipt_image.nbytes / 1024:.0f} KB")
+
+        analyze_blocked = False
+        if 'preflight' in st.session_state:
+            pf = st.session_state.preflight
+            if not pf['ok']:
+                st.error("🚫 Image check failed: " + "; ".join(pf['issues']) + ". Please retake the photo.")
+                analyze_blocked = not st.checkbox("Analyze anyway")
+            elif pf['warnings']:
+                st.warning("⚠️ " + "; ".join(pf['warnings']))
+            else:
+                st.success(f"✅ Image check passed ({pf['elapsed_ms']:.0f} ms)")
+            with st.expander("Image quality details", expanded=False):
+                st.json(pf['metrics'])
 
-        if st.button("🔍 Analyze with AI", type="primary"):
+        if st.button("🔍 Analyze with AI", type="primary", disabled=analyze_blocked):
             timings = {}
             t_start = time.time()
             
@@ -363,55 +353,100 @@ with col1:
                     st.write(f"⏱️ {datetime.now().strftime('%H:%M:%S')} - Preparing image...")
                     timings['start'] = datetime.now().strftime('%H:%M:%S')
                     
-                    # Step 2: API Call
-                    st.write(f"⏱️ {datetime.now().strftime('%H:%M:%S')} - Sending to **{model_name}**...")
+                    # Step 2: Make sure the (first) model is resident (cold load timed separately)
+                    first_model = cascade_fast_model if cascade_on else ocr_text_model if ocr_on else model_name
+                    warm = {"cold": False, "load_seconds": 0.0, "evicted": []}
+                    # OCR mode loads the text or vision model only once it knows which one it needs
+                    if model_manager.is_local(first_model) and not ocr_on:
+                        st.write(f"⏱️ {datetime.now().strftime('%H:%M:%S')} - Checking **{first_model}** is loaded...")
+                        warm = model_manager.ensure_loaded(first_model)
+                        if warm['evicted']:
+                            st.write(f"♻️ Unloaded {', '.join(warm['evicted'])} to stay within the RAM budget")
+
+                    # Step 3: API Call
+                    prompt_version = choose_prompt_version(prompt_mode, ab_ratio)
+                    st.write(f"⏱️ {datetime.now().strftime('%H:%M:%S')} - Sending to **{first_model}** (prompt `{prompt_version}`)...")
                     t_api_start = time.time()
-                    full_response = analyze_receipt_api(st.session_state.image_base64, model_name)
+                    image_base64 = st.session_state.receipt_image.to_base64()  # wire copy for this request only
+                    cascade_info, pipeline_info = None, None
+                    extra_loads = []  # cold loads of models picked mid-request (escalation / fallback)
+                    vision_request = model_manager.with_loading(lambda m: analyze_receipt_api(image_base64, m, prompt_version), extra_loads)
+                    if cascade_on:
+                        full_response, analysis_json, cascade_info = run_cascade(vision_request, cascade_fast_model, model_name, log=st.write)
+                        final_model = cascade_info['final_model']
+                    elif ocr_on:
+                        def post_text(payload):
+                            response = requests.post(OLLAMA_CHAT_URL, json=payload)
+                            response.raise_for_status()
+                            return response.json()
+                        text_request = model_manager.with_loading(post_text, extra_loads)
+                        full_response, analysis_json, pipeline_info = run_ocr_first(
+                            st.session_state.receipt_image.to_bytes(), get_prompt(prompt_version),
+                            vision_request, model_name, text_fn=text_request, text_model=ocr_text_model, log=st.write
+                        )
+                        final_model = ocr_text_model if pipeline_info['mode'] == "ocr" else model_name
+                    else:
+                        full_response = analyze_receipt_api(image_base64, model_name, prompt_version)
+                        final_model = model_name
                     t_api_end = time.time()
-                    timings['api_call_duration'] = f"{t_api_end - t_api_start:.2f}s"
+
+                    # A load can still happen inside the request (e.g. evicted by another session meanwhile)
+                    in_request = model_manager.record_response(final_model, full_response)
+                    in_request_load = (in_request['load_seconds'] if in_request['cold'] else 0.0) + sum(extra_loads)
+                    timings['cold_start'] = warm['cold'] or in_request['cold'] or bool(extra_loads)
+                    timings['cold_load_duration'] = f"{warm['load_seconds'] + in_request_load:.2f}s"
+                    timings['api_call_duration'] = f"{t_api_end - t_api_start - in_request_load:.2f}s"
                     
-                    # Step 3: Parse
+                    # Step 4: Parse
                     st.write(f"⏱️ {datetime.now().strftime('%H:%M:%S')} - Parsing response...")
                     result_content = full_response['message']['content']
-                    
-                    # Extract JSON
-                    json_str = None
-                    # Try markdown json block
-                    match = re.search(r'```json\s*(\{.*?\})\s*```', result_content, re.DOTALL)
-                    if match:
-                        json_str = match.group(1)
-                    else:
-                        # Try finding first/last brace
-                        s = result_content.find('{')
-                        e = result_content.rfind('}')
-                        if s != -1 and e != -1:
-                            json_str = result_content[s:e+1]
-
-                    if json_str:
-                        analysis_json = json.loads(json_str)
-                    else:
-                        raise ValueError("Could not find valid JSON in response")
+                    raw_output = raw_output_of(full_response)
+
+                    # Stats
+                    usage_stats = usage_stats_of(full_response)
+
+                    parse_error = None
+                    if not cascade_info and not pipeline_info:
+                        try:
+                            analysis_json, scratchpad = parse_model_output(result_content)
+                            analysis_json['auditor_scratchpad'] = scratchpad
+                        except (json.JSONDecodeError, ValueError) as e:
+                            parse_error = str(e)
+                    elif analysis_json is None:
+                        # Cascade/OCR passes are already parsed (scratchpad included); None means every pass failed
+                        parse_error = "Could not find valid JSON in response (all passes failed)"
+
+                    if parse_error:
+                        # Keep the raw output so a parser fix can be replayed later without paying for inference again
+                        timings['end'] = datetime.now().strftime('%H:%M:%S')
+                        timings['total_wall_time'] = f"{time.time() - t_start:.2f}s"
+                        failed_result = {
+                            "parse_error": parse_error,
+                            "model_used": full_response.get('model', final_model),
+                            "prompt_version": prompt_version
+                        }
+                        if cascade_info:
+                            failed_result['cascade'] = cascade_info
+                        if pipeline_info:
+                            failed_result['pipeline'] = pipeline_info
+                        save_record("Unparsed", image_base64, failed_result, [], usage_stats, timings, raw_output=raw_output)
+                        st.write("💾 Saved raw model output to history for offline re-parsing.")
+                        raise ValueError(parse_error)
                     
                     # INJECT METADATA INTO JSON
-                    analysis_json['model_used'] = full_response.get('model', model_name)
+                    analysis_json['model_used'] = full_response.get('model', final_model)
+                    analysis_json['prompt_version'] = prompt_version
                     analysis_json['token_usage'] = {
                         "input": full_response.get('prompt_eval_count', 0),
                         "output": full_response.get('eval_count', 0)
                     }
-                    # Also save the raw scratchpad text
-                    analysis_json['auditor_scratchpad'] = result_content.replace(json_str if match else "", "").replace("```json", "").replace("```", "").strip()
+                    if cascade_info:
+                        analysis_json['cascade'] = cascade_info
+                    if pipeline_info:
+                        analysis_json['pipeline'] = pipeline_info
                     
                     st.session_state.analysis_result = analysis_json
-                    
-                    # Stats
-                    st.session_state.usage_stats = {
-                        "Eval Duration": f"{full_response.get('eval_duration', 0)/1e9:.2f}s",
-                        "Prompt Eval": f"{full_response.get('prompt_eval_duration', 0)/1e9:.2f}s",
-                        "Total Duration": f"{full_response.get('total_duration', 0)/1e9:.2f}s",
-                        "Prompt Tokens": full_response.get('prompt_eval_count', 0),
-                        "Output Tokens": full_response.get('eval_count', 0),
-                        "Model": full_response.get('model', 'unknown')
-                    }
+                    st.session_state.usage_stats = usage_stats
                     
                     timings['end'] = datetime.now().strftime('%H:%M:%S')
                     timings['total_wall_time'] = f"{time.time() - t_start:.2f}s"
@@ -421,11 +456,12 @@ with col1:
                     merchant_name = st.session_state.analysis_result.get('extracted_data', {}).get('merchant_name', 'Unknown')
                     filepath = save_record(
                         merchant_name, 
-                        st.session_state.image_base64,
+                        image_base64,
                         st.session_state.analysis_result,
                         [], # Initial chat history is empty
                         st.session_state.usage_stats,
-                        timings
+                        timings,
+                        raw_output=raw_output
                     )
                     st.session_state.current_file_path = filepath
                     st.session_state.chat_history = []
@@ -447,11 +483,30 @@ with col2:
             t = st.session_state.timings
             with st.expander("⏱️ Timing Breakdown", expanded=False):
                 st.write(f"**Start:** {t.get('start')} | **End:** {t.get('end')}")
+                if t.get('cold_start'):
+                    st.write(f"**Cold Model Load:** {t.get('cold_load_duration')}")
                 st.write(f"**Model Inference Time:** {t.get('api_call_duration')}")
                 st.write(f"**Total Workflow Time:** {t.get('total_wall_time')}")
 
         data = st.session_state.analysis_result
         extracted = data.get('extracted_data', {})
+
+        # Cascade summary
+        if data.get('cascade'):
+            c = data['cascade']
+            passes = " → ".join(f"{p['model']} ({p.get('latency', 'failed')})" for p in c.get('passes', []))
+            if c.get('escalated'):
+                st.caption(f"⚡ Cascade escalated: {passes} — {'; '.join(c.get('escalation_reasons', []))}")
+            else:
+                st.caption(f"⚡ Cascade accepted first pass: {passes}")
+        if data.get('pipeline'):
+            p = data['pipeline']
+            ocr = p.get('ocr') or {}
+            ocr_note = f"OCR confidence {ocr['confidence']}, {ocr['elapsed_ms']} ms" if ocr else "OCR unavailable"
+            if p.get('mode') == "ocr":
+                st.caption(f"📝 Answered from OCR text by {p.get('text_model')} ({ocr_note})")
+            else:
+                st.caption(f"📝 OCR fell back to vision ({ocr_note}) — {'; '.join(p.get('fallback_reasons', []))}")
         validation = data.get('validation_result', {})
         
         # Scratchpad
@@ -479,16 +534,49 @@ with col2:
         if confidence_match:
             confidence = confidence_match.group(1) + "%"
         
-        if 'yes' in verdict or 'fraud' in verdict:
+        if data.get('parse_error'):
+            st.warning(f"🧩 Model output could not be parsed ({data['parse_error']}). Raw output is stored; run `python3 replay.py` after a parser fix.")
+        elif 'yes' in verdict or 'fraud' in verdict:
             st.error(f"⚠️ FRAUD SUSPECTED: {validation.get('conclusion')}")
         else:
             # Valid receipt - show enhanced message
             st.success(f"✅ Receipt Validated: No Major Issues, {confidence} Confidence")
         
         st.info(f"**Reasoning:** {validation.get('reasoning')}")
+
+        # Duplicate claim check against the history index
+        duplicates = find_duplicates(
+            extracted.get('receipt_no'),
+            extracted.get('merchant_name'),
+            extracted.get('amount'),
+            exclude_path=st.session_state.get('current_file_path')
+        )
+        if duplicates:
+            st.warning(
+                f"🔁 Possible duplicate claim: receipt no {extracted.get('receipt_no')} already appears in "
+                + ", ".join(os.path.basename(d['path']) for d in duplicates)
+            )
             
         with st.expander("View Raw JSON Data"):
             st.json(data)
+
+        # Reviewer label (scored by the A/B and OCR reports as label accuracy)
+        if st.session_state.get('current_file_path'):
+            with st.expander("🏷️ Reviewer Verdict", expanded=False):
+                review_options = ["Not reviewed", "Yes", "No"]
+                current_review = (data.get('review') or {}).get('conclusion', "Not reviewed")
+                review = st.radio(
+                    "Is this receipt fraudulent?",
+                    review_options,
+                    index=review_options.index(current_review) if current_review in review_options else 0,
+                    format_func=lambda v: {"Yes": "Yes - fraud", "No": "No - valid"}.get(v, v),
+                    horizontal=True
+                )
+                if st.button("Save verdict"):
+                    st.session_state.analysis_result = set_review(
+                        st.session_state.current_file_path, None if review == "Not reviewed" else review
+                    )
+                    st.success("Verdict saved.")
             
         # Token Usage Stats
         st.markdown("---")
@@ -516,7 +604,7 @@ with col2:
                 full_resp = ""
                 
                 try:
-                    resp = chat_api(st.session_state.chat_history[:-1], prompt, st.session_state.image_base64, model_name)
+                    resp = chat_api(st.session_state.chat_history[:-1], prompt, st.session_state.receipt_image.to_base64(), model_name)
                     
                     if model_name.startswith("Together.AI/"):
                         # Non-streaming handle for Together
@@ -548,7 +636,7 @@ with col2:
                     if 'current_file_path' in st.session_state and 'analysis_result' in st.session_state:
                          save_record(
                             st.session_state.analysis_result.get('extracted_data', {}).get('merchant_name', 'Unknown'),
-                            st.session_state.image_base64,
+                            st.session_state.receipt_image.to_base64(),
                             st.session_state.analysis_result,
                             st.session_state.chat_history,
                             st.session_state.usage_stats,
@@ -562,6 +650,73 @@ with col2:
 # Log View Tab
 with tab2:
     st.header("📜 Execution Logs")
+
+    with st.expander("📤 Export for Accounting", expanded=False):
+        ec1, ec2, ec3 = st.columns(3)
+        export_format = ec1.selectbox("Format", ["csv", "parquet"])
+        export_from = ec2.date_input("Receipt date from", value=None, key="export_from")
+        export_to = ec3.date_input("Receipt date to", value=None, key="export_to")
+        if st.button("Export"):
+            # Streamed to disk in chunks; only the finished file is handed to the browser
+            export_path = os.path.join(tempfile.gettempdir(), f"receipts_export_{datetime.now().strftime('%Y%m%d%H%M%S')}.{export_format}")
+            if st.session_state.get('export_file') and os.path.exists(st.session_state.export_file):
+                os.remove(st.session_state.export_file)  # superseded, never downloaded
+            try:
+                with st.spinner("Exporting..."):
+                    n_rows = export_history(export_path, export_format, export_from, export_to, HISTORY_DIR)
+                st.session_state.export_file = export_path
+                st.success(f"Exported {n_rows} records.")
+                undated = count_undated(HISTORY_DIR) if export_from or export_to else 0
+                if undated:
+                    st.warning(f"{undated} records have no readable receipt date and are not in the date range.")
+            except RuntimeError as e:
+                st.error(str(e))
+        if st.session_state.get('export_file') and os.path.exists(st.session_state.export_file):
+            export_file = st.session_state.export_file
+            def serve_export():
+                # Runs once, on click (not on every rerun); the temp file goes once it has been served
+                with open(export_file, "rb") as f:
+                    data = f.read()
+                os.remove(export_file)
+                return data
+            st.download_button("⬇️ Download export", serve_export, file_name=os.path.basename(export_file), on_click="ignore")
+        else:
+            st.session_state.pop('export_file', None)
+
+    with st.expander("⚡ Cascade Metrics", expanded=False):
+        if st.button("Compute cascade metrics"):
+            stats = cascade_stats(HISTORY_DIR)
+            if stats['cascade_records']:
+                cm1, cm2, cm3 = st.columns(3)
+                cm1.metric("Cascade Runs", stats['cascade_records'])
+                cm2.metric("Escalation Rate", f"{stats['escalation_rate'] * 100:.0f}%")
+                cm3.metric("Fast Pass (mean)", f"{stats['mean_fast_pass_s']}s")
+                st.json(stats)
+            else:
+                st.info("No cascade runs recorded yet.")
+
+    with st.expander("📝 OCR vs Vision", expanded=False):
+        st.caption("Latency = whole analysis call (OCR, text pass and any vision fallback). Completeness = all five fields extracted in valid format.")
+        if st.button("Compute pipeline report"):
+            report = pipeline_report(HISTORY_DIR)
+            if "ocr_mode" in report:
+                pm1, pm2, pm3 = st.columns(3)
+                pm1.metric("OCR Attempts", report['ocr_mode']['attempted'])
+                pm2.metric("Fallback Rate", f"{report['ocr_mode']['fallback_rate'] * 100:.0f}%")
+                pm3.metric("OCR Mode Latency (median)", f"{report['ocr_mode']['median_latency_s']}s")
+            if report:
+                st.json(report)
+            else:
+                st.info("No analyses recorded yet.")
+
+    with st.expander("🧪 Prompt A/B Report", expanded=False):
+        st.caption("Prefill = Ollama prompt eval time (cloud models report none). Completeness = all five fields extracted in valid format.")
+        if st.button("Compute report"):
+            report = ab_report(HISTORY_DIR)
+            if report:
+                st.json(report)
+            else:
+                st.info("No records with a prompt version yet.")
     
     # Show loading spinner while loading logs
     with st.spinner("Loading execution logs..."):
@@ -637,7 +792,8 @@ with tab2:
                     # Load this record into session state and switch to Analysis tab
                     with open(log['File Path'], 'r') as f:
                         record = json.load(f)
-                        st.session_state.image_base64 = record['image_base64']
+                        st.session_state.receipt_image = ReceiptImage.from_base64(record['image_base64'], source=log['File Path'])
+                        st.session_state.pop('preflight', None)
                         st.session_state.analysis_result = record['analysis_result']
                         st.session_state.chat_history = record['chat_history']
                         st.session_state.usage_stats = record.get('usage_stats', {})
@@ -0,0 +1,170 @@
+import os
+import csv
+import json
+import argparse
+
+from history_store import HISTORY_DIR, parse_amount, normalize_date, sync_index, connect, index_path_for
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Rows buffered before each write; keeps memory flat regardless of history size
+CHUNK_ROWS = 1000
+# A spreadsheet runs a cell starting with one of these as a formula
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+COLUMNS = [
+    "receipt_date", "merchant_name", "receipt_no", "amount", "location",
+    "fraud_suspected", "reasoning", "model", "prompt_version",
+    "tokens_in", "tokens_out", "analysed_at", "record_file"
+]
+
+def iter_record_paths(date_from=None, date_to=None, history_dir=HISTORY_DIR):
+    """
+    Streams record paths, oldest receipt first, straight off a SQLite cursor.
+    The index is synced first so records written outside the app are included.
+    Dates are compared in the index's normalised YYYY-MM-DD form; with a date range,
+    records without a readable date are left out (see count_undated()).
+    """
+    index_path = index_path_for(history_dir)
+    sync_index(history_dir, index_path)
+    where, params = [], []
+    if date_from:
+        where.append("receipt_date >= ?")
+        params.append(str(date_from))
+    if date_to:
+        where.append("receipt_date <= ?")
+        params.append(str(date_to))
+    sql = "SELECT path FROM receipts"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY receipt_date, path"
+
+    conn = connect(index_path)
+    try:
+        for row in conn.execute(sql, params):
+            yield row['path']
+    finally:
+        conn.close()
+
+def count_undated(history_dir=HISTORY_DIR):
+    """Records whose receipt date couldn't be read; a date-range export can't include them"""
+    conn = connect(index_path_for(history_dir))
+    try:
+        return conn.execute("SELECT COUNT(*) FROM receipts WHERE receipt_date IS NULL").fetchone()[0]
+    finally:
+        conn.close()
+
+def iter_records(paths):
+    """Loads one record at a time and drops the image before passing it on"""
+    for path in paths:
+        try:
+            with open(path, "r") as f:
+                record = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        record.pop('image_base64', None)
+        yield path, record
+
+def record_to_row(path, record):
+    """Flattens a history record into the ledger columns"""
+    analysis = record.get('analysis_result', {}) or {}
+    extracted = analysis.get('extracted_data', {}) or {}
+    validation = analysis.get('validation_result', {}) or {}
+    usage = record.get('usage_stats', {}) or {}
+    return {
+        "receipt_date": normalize_date(extracted.get('receipt_date')) or extracted.get('receipt_date'),
+        "merchant_name": extracted.get('merchant_name') or record.get('merchant'),
+        "receipt_no": extracted.get('receipt_no'),
+        "amount": parse_amount(extracted.get('amount')),
+        "location": extracted.get('location'),
+        "fraud_suspected": str(validation.get('conclusion', '')).strip().lower().startswith('yes'),
+        "reasoning": validation.get('reasoning'),
+        "model": usage.get('Model') or analysis.get('model_used'),
+        "prompt_version": analysis.get('prompt_version'),
+        "tokens_in": usage.get('Prompt Tokens'),
+        "tokens_out": usage.get('Output Tokens'),
+        "analysed_at": record.get('timestamp'),
+        "record_file": os.path.basename(path),
+    }
+
+def iter_rows(date_from=None, date_to=None, history_dir=HISTORY_DIR):
+    for path, record in iter_records(iter_record_paths(date_from, date_to, history_dir)):
+        yield record_to_row(path, record)
+
+def chunked(rows, size=CHUNK_ROWS):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def csv_safe(value):
+    """Merchant, location and reasoning come from uploaded images: keep them from running as formulas"""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def write_csv(rows, output_path):
+    count = 0
+    with open(output_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        for chunk in chunked(rows):
+            writer.writerows({k: csv_safe(v) for k, v in row.items()} for row in chunk)
+            f.flush()
+            count += len(chunk)
+    return count
+
+def write_parquet(rows, output_path):
+    if pa is None:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+    schema = pa.schema([
+        ("receipt_date", pa.string()), ("merchant_name", pa.string()), ("receipt_no", pa.string()),
+        ("amount", pa.float64()), ("location", pa.string()), ("fraud_suspected", pa.bool_()),
+        ("reasoning", pa.string()), ("model", pa.string()), ("prompt_version", pa.string()),
+        ("tokens_in", pa.int64()), ("tokens_out", pa.int64()), ("analysed_at", pa.string()),
+        ("record_file", pa.string()),
+    ])
+    count = 0
+    with pq.ParquetWriter(output_path, schema) as writer:
+        for chunk in chunked(rows):
+            # Models sometimes return numbers/objects where strings are expected
+            for row in chunk:
+                for key, field_type in zip(schema.names, schema.types):
+                    if field_type == pa.string() and row[key] is not None and not isinstance(row[key], str):
+                        row[key] = json.dumps(row[key]) if isinstance(row[key], (dict, list)) else str(row[key])
+                    elif field_type == pa.int64() and not isinstance(row[key], int):
+                        row[key] = None
+            writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+            count += len(chunk)
+    return count
+
+def export_history(output_path, fmt="csv", date_from=None, date_to=None, history_dir=HISTORY_DIR):
+    """Streams matching records to CSV or Parquet. Returns the number of rows written."""
+    rows = iter_rows(date_from, date_to, history_dir)
+    if fmt == "parquet":
+        return write_parquet(rows, output_path)
+    return write_csv(rows, output_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export receipt history for accounting")
+    parser.add_argument("-o", "--output", help="output file (default: receipts_export.<format>)")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--from", dest="date_from", metavar="YYYY-MM-DD", help="first receipt date to include")
+    parser.add_argument("--to", dest="date_to", metavar="YYYY-MM-DD", help="last receipt date to include")
+    args = parser.parse_args()
+
+    output = args.output or f"receipts_export.{args.format}"
+    print(f"📤 Exporting {HISTORY_DIR} to {output} ...")
+    n = export_history(output, args.format, args.date_from, args.date_to)
+    print(f"✅ Wrote {n} records")
+    undated = count_undated() if args.date_from or args.date_to else 0
+    if undated:
+        print(f"⚠️ {undated} records have no readable receipt date and are not in the date range")
@@ -0,0 +1,360 @@
+import os
+import re
+import json
+import glob
+import sqlite3
+from datetime import datetime
+
+# Configuration
+HISTORY_DIR = "receipt_history"
+INDEX_PATH = os.path.join(HISTORY_DIR, "index.db")
+INDEX_VERSION = 1  # bump when _record_row changes so existing indexes re-read every record
+# Receipts print the day first (19/07/2024); models sometimes copy that instead of YYYY-MM-DD
+DATE_FORMATS = ("%Y-%m-%d", "%Y/%m/%d", "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%d/%m/%y", "%d-%m-%y", "%d.%m.%y",
+                "%d %b %Y", "%d %B %Y", "%d-%b-%Y", "%d-%b-%y", "%d %b %y", "%b %d, %Y", "%B %d, %Y")
+
+def index_path_for(history_dir=HISTORY_DIR):
+    """Each history folder has its own index next to its records"""
+    return os.path.join(history_dir, "index.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipts (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime REAL,
+    timestamp TEXT,
+    merchant_name TEXT,
+    receipt_no TEXT,
+    location TEXT,
+    amount REAL,
+    receipt_date TEXT,
+    conclusion TEXT,
+    model TEXT,
+    receipt_no_key TEXT,
+    merchant_key TEXT,
+    amount_cents INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_receipts_amount ON receipts(amount);
+CREATE INDEX IF NOT EXISTS idx_receipts_date ON receipts(receipt_date);
+CREATE INDEX IF NOT EXISTS idx_receipts_mtime ON receipts(mtime);
+CREATE INDEX IF NOT EXISTS idx_receipts_dup ON receipts(receipt_no_key, merchant_key, amount_cents);
+CREATE VIRTUAL TABLE IF NOT EXISTS receipts_fts USING fts5(
+    merchant_name, receipt_no, location, scratchpad, chat,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+def connect(index_path=INDEX_PATH):
+    """Opens the history index, creating the schema on first use"""
+    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(index_path, timeout=10)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    if conn.execute("PRAGMA user_version").fetchone()[0] < INDEX_VERSION:
+        with conn:
+            conn.execute("UPDATE receipts SET mtime = NULL")  # sync_index re-indexes every record
+            conn.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+    return conn
+
+def parse_amount(value):
+    """Turns model output like 'RM 1,005.94' into a float (None if unreadable)"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.search(r'-?\d+(?:\.\d+)?', str(value).replace(",", ""))
+    return float(match.group(0)) if match else None
+
+def normalize_date(value):
+    """Turns a receipt date like '19/07/2024' or '2024-07-19 14:32' into 'YYYY-MM-DD' (None if unreadable)"""
+    text = str(value or "").strip()
+    iso = re.match(r'^(\d{4}-\d{2}-\d{2})[T ]', text)
+    if iso:
+        text = iso.group(1)
+    text = re.split(r'\s+\d{1,2}:\d{2}', text)[0].strip()  # time printed after the date
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+def parse_seconds(value):
+    """Turns a stored duration like '3.42s' into a float (None if unreadable)"""
+    try:
+        return float(str(value).rstrip("s"))
+    except (TypeError, ValueError):
+        return None
+
+def is_complete(extracted):
+    """All five fields present, amount numeric and date in YYYY-MM-DD"""
+    if not all(extracted.get(f) for f in ("merchant_name", "receipt_no", "amount", "receipt_date", "location")):
+        return False
+    if not re.search(r'\d', str(extracted.get('amount'))):
+        return False
+    return bool(re.match(r'^\d{4}-\d{2}-\d{2}$', str(extracted.get('receipt_date'))))
+
+def review_agrees(analysis):
+    """
+    Whether the model's conclusion matches the reviewer's label (analysis_result.review):
+    True / False, or None if the record hasn't been reviewed.
+    """
+    label = str((analysis.get('review') or {}).get('conclusion', '')).strip().lower()
+    if not label:
+        return None
+    conclusion = str((analysis.get('validation_result') or {}).get('conclusion', '')).strip().lower()
+    return label[:1] == conclusion[:1]
+
+def iter_records(history_dir=HISTORY_DIR):
+    """Yields (path, record) for every readable JSON record in a history folder; the reports all start here"""
+    for fpath in glob.glob(os.path.join(history_dir, "*.json")):
+        try:
+            with open(fpath, "r") as f:
+                record = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        yield fpath, record
+
+def _receipt_no_key(receipt_no):
+    return re.sub(r'\s+', '', str(receipt_no or "")).upper()
+
+def _merchant_key(merchant):
+    return re.sub(r'[^0-9a-z]', '', str(merchant or "").lower())
+
+def _amount_cents(amount):
+    return int(round(amount * 100)) if amount is not None else None
+
+def _record_row(filepath, record):
+    analysis = record.get('analysis_result', {}) or {}
+    extracted = analysis.get('extracted_data', {}) or {}
+    validation = analysis.get('validation_result', {}) or {}
+    merchant = extracted.get('merchant_name') or record.get('merchant') or ""
+    amount = parse_amount(extracted.get('amount'))
+    chat = "\n".join(m.get('content', '') for m in record.get('chat_history', []) or [])
+    row = {
+        "path": filepath,
+        "mtime": os.path.getmtime(filepath) if os.path.exists(filepath) else 0,
+        "timestamp": record.get('timestamp'),
+        "merchant_name": merchant,
+        "receipt_no": extracted.get('receipt_no') or "",
+        "location": extracted.get('location') or "",
+        "amount": amount,
+        "receipt_date": normalize_date(extracted.get('receipt_date')),  # ISO, so date ranges compare correctly
+        "conclusion": validation.get('conclusion'),
+        "model": (record.get('usage_stats', {}) or {}).get('Model') or analysis.get('model_used'),
+        "receipt_no_key": _receipt_no_key(extracted.get('receipt_no')),
+        "merchant_key": _merchant_key(merchant),
+        "amount_cents": _amount_cents(amount),
+    }
+    fts = {
+        "merchant_name": merchant,
+        "receipt_no": row['receipt_no'],
+        "location": row['location'],
+        "scratchpad": analysis.get('auditor_scratchpad') or validation.get('reasoning') or "",
+        "chat": chat,
+    }
+    return row, fts
+
+def _upsert(conn, filepath, record):
+    row, fts = _record_row(filepath, record)
+    cur = conn.execute("SELECT id FROM receipts WHERE path = ?", (filepath,))
+    existing = cur.fetchone()
+    if existing:
+        rowid = existing['id']
+        conn.execute(
+            "UPDATE receipts SET " + ", ".join(f"{k} = ?" for k in row) + " WHERE id = ?",
+            list(row.values()) + [rowid]
+        )
+        conn.execute("DELETE FROM receipts_fts WHERE rowid = ?", (rowid,))
+    else:
+        cur = conn.execute(
+            f"INSERT INTO receipts ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+            list(row.values())
+        )
+        rowid = cur.lastrowid
+    conn.execute(
+        "INSERT INTO receipts_fts (rowid, merchant_name, receipt_no, location, scratchpad, chat) VALUES (?, ?, ?, ?, ?, ?)",
+        (rowid, fts['merchant_name'], fts['receipt_no'], fts['location'], fts['scratchpad'], fts['chat'])
+    )
+
+def index_record(filepath, record, index_path=INDEX_PATH):
+    """Adds or refreshes a single history record in the index"""
+    conn = connect(index_path)
+    try:
+        with conn:
+            _upsert(conn, filepath, record)
+    finally:
+        conn.close()
+
+def sync_index(history_dir=HISTORY_DIR, index_path=None):
+    """Brings the index in line with the JSON files on disk (new, modified and deleted records)"""
+    # Syncing another folder into the default index would delete every record it doesn't contain
+    conn = connect(index_path or index_path_for(history_dir))
+    added, removed = 0, 0
+    try:
+        indexed = {r['path']: r['mtime'] for r in conn.execute("SELECT path, mtime FROM receipts")}
+        on_disk = set()
+        with conn:
+            for fpath in glob.glob(os.path.join(history_dir, "*.json")):
+                on_disk.add(fpath)
+                mtime = os.path.getmtime(fpath)
+                if indexed.get(fpath) == mtime:
+                    continue
+                try:
+                    with open(fpath, "r") as f:
+                        record = json.load(f)
+                except (OSError, json.JSONDecodeError):
+                    continue
+                _upsert(conn, fpath, record)
+                added += 1
+            for fpath in set(indexed) - on_disk:
+                rowid = conn.execute("SELECT id FROM receipts WHERE path = ?", (fpath,)).fetchone()['id']
+                conn.execute("DELETE FROM receipts_fts WHERE rowid = ?", (rowid,))
+                conn.execute("DELETE FROM receipts WHERE id = ?", (rowid,))
+                removed += 1
+    finally:
+        conn.close()
+    return {"indexed": added, "removed": removed}
+
+def _fts_query(text):
+    # Quote every term so user input can't inject FTS syntax; prefix-match the last one
+    terms = re.findall(r'\w+', text or "", re.UNICODE)
+    if not terms:
+        return None
+    quoted = [f'"{t}"' for t in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+def search_records(query="", min_amount=None, max_amount=None, date_from=None, date_to=None,
+                   limit=50, index_path=INDEX_PATH):
+    """
+    Full-text search over merchant, receipt no, location, scratchpad and chat,
+    with optional amount and receipt_date (YYYY-MM-DD) range filters.
+    Returns the newest matching records first.
+    """
+    where, params = [], []
+    fts = _fts_query(query)
+    if fts:
+        where.append("r.id IN (SELECT rowid FROM receipts_fts WHERE receipts_fts MATCH ?)")
+        params.append(fts)
+    if min_amount is not None:
+        where.append("r.amount >= ?")
+        params.append(min_amount)
+    if max_amount is not None:
+        where.append("r.amount <= ?")
+        params.append(max_amount)
+    if date_from:
+        where.append("r.receipt_date >= ?")
+        params.append(str(date_from))
+    if date_to:
+        where.append("r.receipt_date <= ?")
+        params.append(str(date_to))
+
+    sql = "SELECT r.* FROM receipts r"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY r.mtime DESC LIMIT ?"
+    params.append(limit)
+
+    conn = connect(index_path)
+    try:
+        return [dict(r) for r in conn.execute(sql, params)]
+    finally:
+        conn.close()
+
+def find_duplicates(receipt_no, merchant, amount, exclude_path=None, index_path=INDEX_PATH):
+    """Exact (receipt_no, merchant, amount) lookup used to flag duplicate claims"""
+    receipt_no_key = _receipt_no_key(receipt_no)
+    amount_cents = _amount_cents(parse_amount(amount))
+    if not receipt_no_key or amount_cents is None:
+        return []
+    conn = connect(index_path)
+    try:
+        rows = conn.execute(
+            "SELECT * FROM receipts WHERE receipt_no_key = ? AND merchant_key = ? AND amount_cents = ?",
+            (receipt_no_key, _merchant_key(merchant), amount_cents)
+        )
+        return [dict(r) for r in rows if r['path'] != exclude_path]
+    finally:
+        conn.close()
+
+def save_record(merchant, image_base64, analysis_result, chat_history, stats, timings, existing_filename=None, raw_output=None):
+    if existing_filename:
+        filename = existing_filename
+        timestamp = datetime.now().strftime("%d-%m-%y-%H%M") # Updated modify time
+    else:
+        # Format: DD-MM-YY-HHMM-Merchant
+        timestamp = datetime.now().strftime("%d-%m-%y-%H%M")
+        safe_merchant = "".join([c for c in merchant if c.isalnum() or c in (' ', '_')]).strip().replace(" ", "_")
+        filename = f"{timestamp}-{safe_merchant}.json"
+        # Batch ingestion can save the same merchant twice in one minute; don't overwrite
+        n = 1
+        while os.path.exists(os.path.join(HISTORY_DIR, filename)):
+            n += 1
+            filename = f"{timestamp}-{safe_merchant}-{n}.json"
+
+    filepath = os.path.join(HISTORY_DIR, filename)
+
+    record = {
+        "timestamp": timestamp,
+        "merchant": merchant,
+        "image_base64": image_base64,
+        "analysis_result": analysis_result,
+        "chat_history": chat_history,
+        "usage_stats": stats,
+        "timings": timings
+    }
+    if raw_output is None and existing_filename and os.path.exists(filepath):
+        # Chat updates re-save the record; carry the original model output over
+        with open(filepath, "r") as f:
+            raw_output = json.load(f).get('raw_output')
+    if raw_output is not None:
+        record["raw_output"] = raw_output
+
+    with open(filepath, "w") as f:
+        json.dump(record, f, indent=2)
+
+    # Keep the search index current without rescanning the folder
+    try:
+        index_record(filepath, record)
+    except sqlite3.Error as e:
+        print(f"⚠️ Warning: Could not update history index: {e}")
+    return filepath
+
+def set_review(filepath, conclusion):
+    """
+    Stores a reviewer's verdict ("Yes" = fraud, "No" = valid; None clears it) under
+    analysis_result.review, which the A/B and OCR reports score label accuracy against.
+    Returns the updated analysis_result.
+    """
+    with open(filepath, "r") as f:
+        record = json.load(f)
+    analysis = record.get('analysis_result') or {}
+    if conclusion is None:
+        analysis.pop('review', None)
+    else:
+        analysis['review'] = {"conclusion": conclusion, "reviewed_at": datetime.now().isoformat(timespec="seconds")}
+    record['analysis_result'] = analysis
+    with open(filepath, "w") as f:
+        json.dump(record, f, indent=2)
+    index_record(filepath, record, index_path_for(os.path.dirname(filepath)))
+    return analysis
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "reindex":
+        print(f"🗂️ Indexing {HISTORY_DIR} ...")
+        print(sync_index())
+    elif len(sys.argv) > 1 and sys.argv[1] == "search":
+        for r in search_records(" ".join(sys.argv[2:])):
+            print(f"{r['receipt_date'] or '----------'}  RM {r['amount'] or 0:>10.2f}  {r['merchant_name']}  ({r['path']})")
+    elif len(sys.argv) > 3 and sys.argv[1] == "review" and sys.argv[3].lower() in ("yes", "no", "clear"):
+        verdict = {"yes": "Yes", "no": "No", "clear": None}[sys.argv[3].lower()]
+        set_review(sys.argv[2], verdict)
+        print(f"🏷️ {os.path.basename(sys.argv[2])}: {'review cleared' if verdict is None else 'fraud' if verdict == 'Yes' else 'valid'}")
+    else:
+        print("Usage: python3 history_store.py reindex")
+        print("       python3 history_store.py search <terms>")
+        print("       python3 history_store.py review <record.json> yes|no|clear   # reviewer verdict: fraud / valid")
@@ -0,0 +1,148 @@
+import io
+import time
+
+import numpy as np
+from PIL import Image, ImageOps
+
+# Thresholds (tuned on phone photos and flatbed scans of Malaysian receipts)
+MIN_SIDE_PX = 400            # shorter side; below this digits are unreadable to the vision models
+MIN_PIXELS = 300_000         # ~0.3 MP
+BLUR_MIN_VARIANCE = 40.0     # Laplacian variance on the normalised grayscale image
+DARK_MAX_MEAN = 60           # mean brightness (0-255) below this is too dark
+BRIGHT_MIN_MEAN = 245        # above this the paper is washed out
+CLIPPED_MAX_FRACTION = 0.6   # share of pixels crushed to black / blown to white
+WASHED_OUT_MAX_INK = 0.002   # bright images are only washed out if (almost) no pixel is darker than mid-grey
+BLANK_MAX_STD = 10.0         # almost no contrast at all = blank page / lens cap
+TEXT_DENSITY_MIN = 0.01      # share of strong-edge pixels; below this there is no printed text
+TEXT_DENSITY_BUSY = 0.35     # above this it's a busy photo (background clutter); warn
+TEXT_DENSITY_MAX = 0.6       # above this it's texture/noise/scenery, not a receipt
+ASPECT_WARN = (0.5, 8.0)     # height/width; outside this is unusual for a receipt photo
+ANALYSIS_WIDTH = 1000        # images are downscaled to this width for the checks
+
+def _load_gray(source):
+    if isinstance(source, Image.Image):
+        img = source
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        img = Image.open(io.BytesIO(source))
+    else:
+        img = Image.open(source)
+    img = ImageOps.exif_transpose(img)
+    size = img.size
+    gray = img.convert("L")
+    if gray.width > ANALYSIS_WIDTH:
+        gray = gray.resize((ANALYSIS_WIDTH, max(1, round(gray.height * ANALYSIS_WIDTH / gray.width))))
+    return size, np.asarray(gray, dtype=np.float32)
+
+def laplacian_variance(gray):
+    """Variance of the 4-neighbour Laplacian: low = few sharp edges = blurry"""
+    lap = (-4 * gray[1:-1, 1:-1]
+           + gray[:-2, 1:-1] + gray[2:, 1:-1]
+           + gray[1:-1, :-2] + gray[1:-1, 2:])
+    return float(lap.var())
+
+def edge_density(gray, threshold=40):
+    """Share of pixels with a strong horizontal or vertical gradient (printed text is dense in these)"""
+    gx = np.abs(np.diff(gray, axis=1))[:-1, :]
+    gy = np.abs(np.diff(gray, axis=0))[:, :-1]
+    return float(((gx > threshold) | (gy > threshold)).mean())
+
+def preflight(source):
+    """
+    Fast quality gate run before inference. `source` is image bytes, a path or a PIL image.
+    Returns {"ok", "issues" (blocking), "warnings", "metrics", "elapsed_ms"}.
+    """
+    t_start = time.time()
+    issues, warnings = [], []
+    try:
+        (width, height), gray = _load_gray(source)
+    except Exception as e:
+        return {"ok": False, "issues": [f"Not a readable image ({e})"], "warnings": [], "metrics": {}, "elapsed_ms": 0}
+
+    # Sharpness is measured on a contrast-normalised image so faded thermal paper isn't called blurry
+    spread = gray.max() - gray.min()
+    normalised = (gray - gray.min()) * (255.0 / spread) if spread > 0 else gray
+    hist = np.histogram(gray, bins=256, range=(0, 256))[0] / gray.size
+
+    metrics = {
+        "width": width,
+        "height": height,
+        "blur_score": round(laplacian_variance(normalised), 1),
+        "mean_brightness": round(float(gray.mean()), 1),
+        "contrast_std": round(float(gray.std()), 1),
+        "dark_fraction": round(float(hist[:20].sum()), 3),
+        "bright_fraction": round(float(hist[251:].sum()), 3),
+        "ink_fraction": round(float(hist[:128].sum()), 4),
+        "text_density": round(edge_density(gray), 4),
+        "aspect": round(height / width, 2) if width else 0,
+    }
+
+    if min(width, height) < MIN_SIDE_PX or width * height < MIN_PIXELS:
+        issues.append(f"Resolution too low ({width}x{height}); need at least {MIN_SIDE_PX}px on the short side")
+    if metrics['mean_brightness'] < DARK_MAX_MEAN or metrics['dark_fraction'] > CLIPPED_MAX_FRACTION:
+        issues.append("Image is too dark")
+    elif metrics['contrast_std'] < BLANK_MAX_STD:
+        issues.append("Image is blank or has almost no contrast")
+    elif (metrics['mean_brightness'] > BRIGHT_MIN_MEAN and metrics['bright_fraction'] > CLIPPED_MAX_FRACTION
+          # White paper is bright by nature; it's only overexposed when the text is gone too
+          and (metrics['ink_fraction'] < WASHED_OUT_MAX_INK or metrics['text_density'] < TEXT_DENSITY_MIN)):
+        issues.append("Image is overexposed (text washed out)")
+    elif metrics['blur_score'] < BLUR_MIN_VARIANCE:
+        issues.append(f"Image is too blurry (sharpness {metrics['blur_score']} < {BLUR_MIN_VARIANCE})")
+    elif metrics['text_density'] < TEXT_DENSITY_MIN:
+        issues.append("No printed text detected - is this a receipt?")
+    elif metrics['text_density'] > TEXT_DENSITY_MAX:
+        issues.append("Doesn't look like a receipt (texture or scenery, not printed text)")
+    elif metrics['text_density'] > TEXT_DENSITY_BUSY:
+        warnings.append("Image looks busy for a receipt (photo or background clutter)")
+    if not ASPECT_WARN[0] <= metrics['aspect'] <= ASPECT_WARN[1]:
+        warnings.append(f"Unusual shape for a receipt (height/width {metrics['aspect']})")
+
+    return {
+        "ok": not issues,
+        "issues": issues,
+        "warnings": warnings,
+        "metrics": metrics,
+        "elapsed_ms": round((time.time() - t_start) * 1000, 1)
+    }
+
+def _synthetic_receipt(ink=(0, 0, 0), size=(1080, 2400)):
+    from PIL import ImageDraw
+    img = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(img)
+    for y in range(60, size[1] - 100, 40):
+        draw.text((60, y), "NASI LEMAK AYAM     2 x 12.50      25.00", fill=ink)
+    return img
+
+def selfcheck():
+    """Regression cases for the thresholds; returns the list of failures"""
+    clean = _synthetic_receipt()
+    png = io.BytesIO()
+    clean.save(png, format="PNG")
+    cases = [
+        ("clean black-on-white receipt", clean, True),
+        ("clean receipt as PNG bytes (scan / e-receipt screenshot)", png.getvalue(), True),
+        ("faded text", _synthetic_receipt(ink=(215, 215, 215)), False),
+        ("blank white page", Image.new("RGB", (1080, 2400), "white"), False),
+        ("black frame", Image.new("RGB", (1080, 2400), "black"), False),
+        ("tiny image", _synthetic_receipt(size=(200, 300)), False),
+    ]
+    failures = []
+    for name, source, expected in cases:
+        result = preflight(source)
+        status = "✅" if result['ok'] == expected else "❌"
+        print(f"{status} {name}: ok={result['ok']} {result['issues']}")
+        if result['ok'] != expected:
+            failures.append(name)
+    return failures
+
+if __name__ == "__main__":
+    import sys
+    import json
+    if len(sys.argv) > 1 and sys.argv[1] == "selfcheck":
+        sys.exit(1 if selfcheck() else 0)
+    elif len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            print(path, json.dumps(preflight(path), indent=2))
+    else:
+        print("Usage: python3 image_preflight.py <images...>   # check images")
+        print("       python3 image_preflight.py selfcheck     # threshold regression cases")
@@ -0,0 +1,525 @@
+# Load harness for app.py.
+# Starts one headless `streamlit run app.py` against a local mock Ollama server and drives N concurrent
+# sessions at it over Streamlit's own websocket protocol, as N browser tabs would: upload -> analyze ->
+# chat -> Logs tab browsing. Reports rerun latency percentiles, the server process's RSS over time and
+# the session count where the server saturates. Each concurrency level gets a fresh server.
+#
+#   python3 loadtest.py --sessions 1,2,4,8,16 --latency 2.0 --seed-records 500
+#   python3 loadtest.py mock --port 11500 --latency 3   # mock server only (point the real app at it)
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from urllib.parse import urljoin
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from websockets.sync.client import connect as ws_connect   # installed with streamlit
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.Common_pb2 import FileURLsRequest, FileUploaderState, UploadedFileInfo
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+from streamlit.proto.Alert_pb2 import Alert
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(APP_DIR, "app.py")
+MOCK_MODEL = "mock-vision:latest"
+
+MERCHANTS = ["Tesco Extra", "AEON Big", "Mydin", "Village Grocer", "Starbucks", "Nasi Kandar Pelita", "Switch"]
+
+# --- Mock Ollama server ---
+
+def mock_analysis_content():
+    merchant = random.choice(MERCHANTS)
+    amount = round(random.uniform(5, 500), 2)
+    data = {
+        "extracted_data": {
+            "merchant_name": merchant,
+            "receipt_no": f"INV{random.randint(100000, 999999)}",
+            "amount": f"{amount:.2f}",
+            "receipt_date": f"2025-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}",
+            "location": "Jalan Ampang, Kuala Lumpur"
+        },
+        "validation_result": {
+            "reasoning": "Line items sum to subtotal, SST 6% on subtotal. 92% confidence.",
+            "conclusion": "No"
+        }
+    }
+    return ("### AUDITOR SCRATCHPAD\n1. **Item Analysis:**\n   - Item | Qty: 1 | Unit: 1.00 | Total: 1.00\n"
+            "3. **Verdict:** VALID\n\n```json\n" + json.dumps(data, indent=2) + "\n```")
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    latency = 1.0
+    jitter = 0.2
+
+    def log_message(self, *args):
+        pass
+
+    def _sleep(self):
+        time.sleep(max(0.0, random.gauss(self.latency, self.latency * self.jitter)))
+
+    def _json(self, body):
+        raw = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._json({"models": [{"name": MOCK_MODEL, "size": 3 * 1024 ** 3}]})
+        elif self.path == "/api/ps":
+            self._json({"models": [{"name": MOCK_MODEL, "size": 3 * 1024 ** 3}]})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if self.path == "/api/generate":
+            self._json({"model": payload.get("model"), "done": True, "load_duration": 1_000_000})
+        elif self.path == "/api/chat" and payload.get("stream"):
+            self._sleep()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            for word in "This receipt looks consistent with Malaysian SST rules.".split():
+                self.wfile.write(json.dumps({"message": {"role": "assistant", "content": word + " "}, "done": False}).encode() + b"\n")
+            self.wfile.write(json.dumps({"message": {"role": "assistant", "content": ""}, "done": True}).encode() + b"\n")
+        elif self.path == "/api/chat":
+            t_start = time.time()
+            self._sleep()
+            elapsed = int((time.time() - t_start) * 1e9)
+            self._json({
+                "model": payload.get("model"),
+                "message": {"role": "assistant", "content": mock_analysis_content()},
+                "prompt_eval_count": 1500, "eval_count": 400,
+                "prompt_eval_duration": elapsed // 2, "eval_duration": elapsed // 2,
+                "total_duration": elapsed, "load_duration": 1_000_000
+            })
+        else:
+            self.send_error(404)
+
+def start_mock_server(port=0, latency=1.0, jitter=0.2):
+    """Starts the mock in a daemon thread; returns (server, base_url)"""
+    handler = type("Handler", (MockOllamaHandler,), {"latency": latency, "jitter": jitter})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+# --- Measurement helpers ---
+
+def process_rss_mb(pid):
+    """Resident memory of another process in MB (None once it has exited)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        return None
+    except OSError:
+        pass
+    try:  # no /proc (macOS)
+        out = subprocess.run(["ps", "-o", "rss=", "-p", str(pid)], capture_output=True, text=True).stdout.strip()
+        return int(out) / 1024 if out else None
+    except (OSError, ValueError):
+        return None
+
+class RssSampler(threading.Thread):
+    """Samples one process's RSS every `interval` seconds: [(seconds since start, MB)]"""
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        t0 = time.time()
+        while not self._stop_event.is_set():
+            mb = process_rss_mb(self.pid)
+            if mb is not None:
+                self.samples.append((round(time.time() - t0, 1), round(mb, 1)))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join(timeout=2)
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+# --- App server ---
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_app_server(ollama_url, workdir, log_path, timeout=60):
+    """Starts `streamlit run app.py` headless in workdir; returns (process, base_url) once it answers health checks"""
+    port = free_port()
+    cmd = [
+        sys.executable, "-m", "streamlit", "run", APP_PATH,
+        "--server.headless", "true", "--server.address", "127.0.0.1", "--server.port", str(port),
+        "--server.fileWatcherType", "none", "--browser.gatherUsageStats", "false",
+        # The harness isn't a browser: no XSRF cookie to echo back on uploads
+        "--server.enableXsrfProtection", "false",
+    ]
+    log = open(log_path, "w")
+    proc = subprocess.Popen(cmd, cwd=workdir, env=dict(os.environ, OLLAMA_API_BASE=ollama_url),
+                            stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            break
+        try:
+            if requests.get(f"{base_url}/_stcore/health", timeout=1).ok:
+                return proc, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    stop_app_server(proc)
+    with open(log_path) as f:
+        raise RuntimeError("streamlit server didn't start:\n" + f.read()[-2000:])
+
+def stop_app_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+# --- Simulated session ---
+
+def make_receipt_jpeg(width=1000, height=2400):
+    from PIL import Image, ImageDraw
+    img = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(img)
+    for y in range(40, height - 40, 36):
+        draw.text((40, y), f"ITEM {y:05d} ........ 1 x RM {y % 97}.50", fill="black")
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+def seed_history(history_dir, count, image_bytes):
+    """Pre-populates history so Logs-tab scans run against a realistic size"""
+    import base64
+    os.makedirs(history_dir, exist_ok=True)
+    image_base64 = base64.b64encode(image_bytes).decode("utf-8")
+    for i in range(count):
+        content = mock_analysis_content()
+        analysis = json.loads(content[content.index("{"):content.rindex("}") + 1])
+        record = {
+            "timestamp": "01-01-25-0000",
+            "merchant": analysis["extracted_data"]["merchant_name"],
+            "image_base64": image_base64,
+            "analysis_result": analysis,
+            "chat_history": [],
+            "usage_stats": {"Model": MOCK_MODEL, "Prompt Tokens": 1500, "Output Tokens": 400},
+            "timings": {"total_wall_time": "1.00s"}
+        }
+        with open(os.path.join(history_dir, f"seed-{i:06d}.json"), "w") as f:
+            json.dump(record, f)
+
+class StreamlitSession:
+    """
+    One browser tab: BackMsg protobufs up the websocket, ForwardMsg deltas down.
+    Like the frontend, it keeps widget state client-side and resends it with every rerun;
+    button clicks and chat messages are one-shot triggers on top of that.
+    """
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session_id = None
+        self.elements = []        # elements rendered by the last finished run
+        self.widget_states = {}   # widget id -> WidgetState sent with every rerun
+        self._conn = self._ws = None
+
+    def __enter__(self):
+        ws_url = self.base_url.replace("http://", "ws://", 1) + "/_stcore/stream"
+        self._conn = ws_connect(ws_url, subprotocols=["streamlit"], max_size=None, open_timeout=self.timeout)
+        self._ws = self._conn.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self._conn.__exit__(*exc)
+
+    def _recv(self, deadline):
+        msg = ForwardMsg()
+        msg.ParseFromString(self._ws.recv(timeout=max(0.1, deadline - time.time())))
+        if msg.WhichOneof("type") == "new_session" and msg.new_session.initialize.session_id:
+            self.session_id = msg.new_session.initialize.session_id
+        return msg
+
+    def rerun(self, *triggers):
+        """Reruns the script with the current widget state plus one-shot triggers; returns once the run finishes"""
+        back = BackMsg()
+        back.rerun_script.query_string = ""
+        back.rerun_script.widget_states.widgets.extend(list(self.widget_states.values()) + list(triggers))
+        self._ws.send(back.SerializeToString())
+
+        deadline = time.time() + self.timeout
+        elements = []
+        while True:
+            msg = self._recv(deadline)
+            kind = msg.WhichOneof("type")
+            if kind == "new_session":
+                elements = []  # st.rerun() inside the script starts the page over
+            elif kind == "delta" and msg.delta.WhichOneof("type") == "new_element":
+                elements.append(msg.delta.new_element)
+            elif kind == "script_finished" and msg.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                self.elements = elements
+                return
+
+    def find(self, kind, match=lambda e: True):
+        return [getattr(e, kind) for e in self.elements if e.WhichOneof("type") == kind and match(getattr(e, kind))]
+
+    def upload(self, name, data):
+        """Uploads a file through st.file_uploader the way the frontend does, then reruns"""
+        uploader = self.find("file_uploader")
+        if not uploader:
+            raise RuntimeError("no file uploader on the page")
+        back = BackMsg()
+        back.file_urls_request.CopyFrom(FileURLsRequest(request_id=uuid.uuid4().hex, file_names=[name],
+                                                        session_id=self.session_id))
+        self._ws.send(back.SerializeToString())
+        deadline = time.time() + self.timeout
+        while True:
+            msg = self._recv(deadline)
+            if msg.WhichOneof("type") == "file_urls_response":
+                urls = msg.file_urls_response.file_urls[0]
+                break
+        res = requests.put(urljoin(self.base_url, urls.upload_url), files={"file": (name, data, "image/jpeg")},
+                           timeout=self.timeout)
+        res.raise_for_status()
+        info = UploadedFileInfo(name=name, size=len(data), file_id=urls.file_id, file_urls=urls)
+        state = WidgetState(id=uploader[0].id)
+        state.file_uploader_state_value.CopyFrom(FileUploaderState(uploaded_file_info=[info]))
+        self.widget_states[state.id] = state
+        self.rerun()
+
+    def click(self, match):
+        buttons = self.find("button", match)
+        if not buttons or buttons[0].disabled:
+            raise RuntimeError("button not on the page" if not buttons else f"button '{buttons[0].label}' is disabled")
+        self.rerun(WidgetState(id=buttons[0].id, trigger_value=True))
+
+    def chat(self, text):
+        chat_input = self.find("chat_input")
+        if not chat_input:
+            raise RuntimeError("no chat input on the page")
+        state = WidgetState(id=chat_input[0].id)
+        state.chat_input_value.data = text
+        self.rerun(state)
+
+    def check_rendered(self):
+        """None if the last run rendered through to the Logs tab, else what went wrong"""
+        exceptions = self.find("exception")
+        if exceptions:
+            return f"{exceptions[0].type}: {exceptions[0].message}"
+        if not self.elements:
+            return "script rendered nothing"
+        if not self.find("heading", lambda h: h.body == "📜 Execution Logs"):
+            return "script stopped before the Execution Logs tab"
+        return None
+
+    def errors_shown(self):
+        return [a.body for a in self.find("alert", lambda a: a.format == Alert.ERROR)]
+
+CHAT_REPLY = "consistent with Malaysian SST"  # from the mock's streamed chat answer
+
+def run_session(session_id, base_url, image_bytes, iterations, timeout, barrier, results):
+    """One user: upload, analyze, chat, then browse the Logs tab, `iterations` times"""
+    def timed(step, fn, check=None):
+        t_start = time.time()
+        error = None
+        try:
+            fn()
+            error = session.check_rendered() or (check() if check else None)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        results.append({"session": session_id, "step": step, "start": t_start,
+                        "seconds": time.time() - t_start, "error": error})
+
+    try:
+        barrier.wait(timeout=60)
+        with StreamlitSession(base_url, timeout) as session:
+            timed("initial_load", session.rerun)
+            for i in range(iterations):
+                # A new file each time: the app keys its state reset on the upload's file id
+                timed("upload_rerun", lambda: session.upload(f"loadtest-{session_id}-{i}.jpg", image_bytes))
+
+                def analysed():
+                    if session.errors_shown():
+                        return "analysis failed: " + session.errors_shown()[0]
+                    return None if session.find("metric", lambda m: m.label == "Merchant") else "analysis showed no result"
+                timed("analyze", lambda: session.click(lambda b: b.label == "🔍 Analyze with AI"), analysed)
+
+                if session.find("chat_input"):
+                    replies = len(session.find("markdown", lambda m: CHAT_REPLY in m.body))
+                    def answered():
+                        return None if len(session.find("markdown", lambda m: CHAT_REPLY in m.body)) > replies else "chat got no answer"
+                    timed("chat", lambda: session.chat("Is the SST correct?"), answered)
+
+                # Every rerun renders the Execution Logs tab (history scan); open a JSON detail as a user would
+                if session.find("button", lambda b: "json_btn_" in b.id):
+                    timed("logs_browse", lambda: session.click(lambda b: "json_btn_" in b.id))
+                timed("idle_rerun", session.rerun)
+    except Exception as e:
+        results.append({"session": session_id, "step": "session", "start": time.time(),
+                        "seconds": 0.0, "error": f"{type(e).__name__}: {e}"})
+
+def run_level(n_sessions, image_bytes, iterations, timeout, ollama_url, workdir):
+    """
+    Starts a fresh app server and runs n sessions against it at once.
+    Returns (step results, wall seconds, server RSS {"baseline_mb", "peak_mb", "timeline"}).
+    """
+    proc, base_url = start_app_server(ollama_url, workdir, os.path.join(workdir, f"streamlit-{n_sessions}.log"))
+    results, barrier = [], threading.Barrier(n_sessions)
+    sampler = RssSampler(proc.pid)
+    try:
+        # One throwaway run first so the baseline already holds the app's imports, not just a bare server
+        with StreamlitSession(base_url, timeout) as warmup:
+            warmup.rerun()
+        baseline = process_rss_mb(proc.pid)
+        sampler.start()
+        threads = [
+            threading.Thread(target=run_session, args=(i, base_url, image_bytes, iterations, timeout, barrier, results), daemon=True)
+            for i in range(n_sessions)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=60 + timeout * (iterations * 6 + 2))
+        if any(t.is_alive() for t in threads):
+            results.append({"session": None, "step": "session", "start": time.time(), "seconds": 0.0,
+                            "error": "session hung past its time budget"})
+        if proc.poll() is not None:
+            results.append({"session": None, "step": "server", "start": time.time(), "seconds": 0.0,
+                            "error": f"streamlit server exited with code {proc.returncode}"})
+    finally:
+        sampler.stop()
+        stop_app_server(proc)
+
+    spans = [(r['start'], r['start'] + r['seconds']) for r in results]
+    wall = max(e for _, e in spans) - min(s for s, _ in spans) if spans else 0
+    rss = {
+        "baseline_mb": round(baseline, 1) if baseline else None,
+        "peak_mb": max((mb for _, mb in sampler.samples), default=None),
+        "timeline": sampler.samples,
+    }
+    return results, wall, rss
+
+def summarize(n_sessions, results, wall, rss):
+    # Rerun latency excludes analyze/chat, whose time is dominated by the (mock) model
+    reruns = [r['seconds'] for r in results if r['step'] not in ("analyze", "chat") and not r['error']]
+    analyze = [r['seconds'] for r in results if r['step'] == "analyze" and not r['error']]
+    grown = rss['peak_mb'] - rss['baseline_mb'] if rss['peak_mb'] and rss['baseline_mb'] else None
+    return {
+        "sessions": n_sessions,
+        "steps": len(results),
+        "errors": sum(1 for r in results if r['error']),
+        "throughput_steps_per_s": round(len(results) / wall, 2) if wall else None,
+        "rerun_p50_s": round(percentile(reruns, 50), 3) if reruns else None,
+        "rerun_p95_s": round(percentile(reruns, 95), 3) if reruns else None,
+        "rerun_p99_s": round(percentile(reruns, 99), 3) if reruns else None,
+        "analyze_p95_s": round(percentile(analyze, 95), 3) if analyze else None,
+        "server_rss_baseline_mb": rss['baseline_mb'],
+        "server_rss_peak_mb": rss['peak_mb'],
+        "server_rss_mb_per_session": round(grown / n_sessions, 1) if grown is not None else None,
+        "server_rss_timeline": rss['timeline'],  # [(seconds, MB)] sampled every 0.5 s
+    }
+
+def find_saturation(levels, slo_s):
+    """First level where p95 rerun latency breaks the SLO, errors appear, or throughput stops growing (<10%)"""
+    prev = None
+    for level in levels:
+        if level['errors'] or (level['rerun_p95_s'] or 0) > slo_s:
+            return level['sessions']
+        if prev and level['throughput_steps_per_s'] < prev['throughput_steps_per_s'] * 1.1:
+            return level['sessions']
+        prev = level
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for app.py")
+    parser.add_argument("mode", nargs="?", choices=["run", "mock"], default="run")
+    parser.add_argument("--sessions", default="1,2,4,8", help="comma-separated concurrency levels to ramp through")
+    parser.add_argument("--iterations", type=int, default=2, help="upload/analyze/chat/logs cycles per session")
+    parser.add_argument("--latency", type=float, default=1.0, help="mock model latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="latency std-dev as a fraction of --latency")
+    parser.add_argument("--seed-records", type=int, default=0, help="history records to create before the run")
+    parser.add_argument("--slo", type=float, default=2.0, help="p95 rerun latency (s) considered saturated")
+    parser.add_argument("--port", type=int, default=0, help="mock server port (mock mode)")
+    parser.add_argument("--report", help="write the full JSON report here")
+    args = parser.parse_args()
+
+    if args.mode == "mock":
+        server, url = start_mock_server(args.port, args.latency, args.jitter)
+        print(f"🦙 Mock Ollama on {url} (latency {args.latency}s). Run: OLLAMA_API_BASE={url} streamlit run app.py")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+        return
+
+    server, url = start_mock_server(latency=args.latency, jitter=args.jitter)
+
+    # The app writes receipt_history/ relative to cwd: run the server in a scratch dir so real history is untouched
+    workdir = tempfile.mkdtemp(prefix="receiptguard-load-")
+    image_bytes = make_receipt_jpeg()
+    if args.seed_records:
+        print(f"🌱 Seeding {args.seed_records} history records...")
+        seed_history(os.path.join(workdir, "receipt_history"), args.seed_records, image_bytes)
+
+    levels, errors = [], {}
+    try:
+        for n in [int(x) for x in args.sessions.split(",") if x.strip()]:
+            print(f"🚦 {n} concurrent session(s)...")
+            results, wall, rss = run_level(n, image_bytes, args.iterations, max(30, args.latency * 10), url, workdir)
+            summary = summarize(n, results, wall, rss)
+            levels.append(summary)
+            errors[n] = sorted({f"{r['step']}: {r['error']}" for r in results if r['error']})
+            print(f"   rerun p50 {summary['rerun_p50_s']}s | p95 {summary['rerun_p95_s']}s | p99 {summary['rerun_p99_s']}s"
+                  f" | analyze p95 {summary['analyze_p95_s']}s | {summary['throughput_steps_per_s']} steps/s"
+                  f" | server RSS {summary['server_rss_peak_mb']} MB peak ({summary['server_rss_mb_per_session']} MB/session)"
+                  f" | errors {summary['errors']}")
+            for line in errors[n][:5]:
+                print(f"   ❌ {line}")
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    saturation = find_saturation(levels, args.slo)
+    print("\n📈 Server saturation point: " + (f"{saturation} concurrent sessions" if saturation else "not reached"))
+    print(f"🧠 Peak server RSS: {max((l['server_rss_peak_mb'] or 0 for l in levels), default=0)} MB")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"levels": levels, "saturation_sessions": saturation, "errors": errors}, f, indent=2)
+        print(f"💾 Report saved to {args.report}")
+
+if __name__ == "__main__":
+    main()
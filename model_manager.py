@@ -0,0 +1,169 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import requests
+
+# Configuration
+OLLAMA_API_BASE = os.getenv("OLLAMA_API_BASE", "http://localhost:11434")
+# How long Ollama keeps a model in memory after the last request
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# RAM we allow resident models to use. 8 GB machines need ~3 GB left for macOS + Streamlit.
+RAM_BUDGET_BYTES = int(float(os.getenv("OLLAMA_RAM_BUDGET_GB", "5")) * 1024 ** 3)
+# Ollama reports a few ms of load_duration even for a resident model; anything above this was a real load
+COLD_LOAD_THRESHOLD_S = 0.5
+
+class OllamaModelManager:
+    """
+    Keeps the models we use resident in Ollama within a RAM budget.
+    - preload()/ensure_loaded() load a model with keep_alive so the first analysis doesn't pay for it
+    - resident() asks /api/ps what is actually in memory
+    - before loading, least recently used models are unloaded until the new one fits the budget
+    Cloud (Together.AI) models are ignored.
+    """
+
+    def __init__(self, api_base=OLLAMA_API_BASE, ram_budget_bytes=RAM_BUDGET_BYTES, keep_alive=OLLAMA_KEEP_ALIVE):
+        self.api_base = api_base
+        self.ram_budget_bytes = ram_budget_bytes
+        self.keep_alive = keep_alive
+        self._lru = OrderedDict()   # model -> last used (oldest first)
+        self._sizes = {}            # model -> bytes, from /api/tags then /api/ps once loaded
+        self._lock = threading.Lock()
+        self._loading = set()
+
+    @staticmethod
+    def is_local(model):
+        return bool(model) and not model.startswith("Together.AI/")
+
+    def resident(self):
+        """Models currently loaded by Ollama: {name: size_bytes}"""
+        try:
+            res = requests.get(f"{self.api_base}/api/ps", timeout=2)
+            res.raise_for_status()
+            models = res.json().get('models', []) or []
+        except (requests.RequestException, ValueError):
+            return {}
+        resident = {m['name']: m.get('size', 0) for m in models}
+        self._sizes.update(resident)
+        return resident
+
+    def _expected_size(self, model):
+        if model in self._sizes:
+            return self._sizes[model]
+        try:
+            res = requests.get(f"{self.api_base}/api/tags", timeout=2)
+            res.raise_for_status()
+            for m in res.json().get('models', []) or []:
+                self._sizes.setdefault(m['name'], m.get('size', 0))
+        except (requests.RequestException, ValueError):
+            pass
+        return self._sizes.get(model, 0)
+
+    def touch(self, model):
+        """Marks a model as most recently used"""
+        with self._lock:
+            self._lru.pop(model, None)
+            self._lru[model] = time.time()
+
+    def evict(self, model):
+        """Asks Ollama to unload a model right away"""
+        try:
+            requests.post(f"{self.api_base}/api/generate", json={"model": model, "keep_alive": 0}, timeout=10)
+        except requests.RequestException:
+            pass
+        with self._lock:
+            self._lru.pop(model, None)
+
+    def _make_room(self, model, resident):
+        needed = self._expected_size(model)
+        used = sum(size for name, size in resident.items() if name != model)
+        if used + needed <= self.ram_budget_bytes:
+            return []
+        # Models Ollama holds that we never used count as oldest
+        with self._lock:
+            order = [m for m in resident if m not in self._lru] + [m for m in self._lru if m in resident]
+        evicted = []
+        for victim in order:
+            if victim == model or used + needed <= self.ram_budget_bytes:
+                continue
+            self.evict(victim)
+            used -= resident[victim]
+            evicted.append(victim)
+        return evicted
+
+    def ensure_loaded(self, model):
+        """
+        Makes sure `model` is resident before a request.
+        Returns {"cold": bool, "load_seconds": float, "evicted": [models]}.
+        """
+        info = {"cold": False, "load_seconds": 0.0, "evicted": []}
+        if not self.is_local(model):
+            return info
+
+        resident = self.resident()
+        if model in resident:
+            self.touch(model)
+            return info
+
+        info['evicted'] = self._make_room(model, resident)
+        t_start = time.time()
+        try:
+            res = requests.post(
+                f"{self.api_base}/api/generate",
+                json={"model": model, "keep_alive": self.keep_alive},
+                timeout=600
+            )
+            res.raise_for_status()
+        except requests.RequestException:
+            # Let the real request surface the error
+            return info
+        info['cold'] = True
+        info['load_seconds'] = time.time() - t_start
+        self.touch(model)
+        return info
+
+    def with_loading(self, request_fn, loads):
+        """
+        Wraps request_fn so the model is made resident right before each call.
+        request_fn takes a model name or an Ollama payload dict (the model is read from it).
+        Seconds spent on cold loads are appended to `loads`, so callers can keep them out of inference time.
+        """
+        def wrapped(model_or_payload):
+            model = model_or_payload['model'] if isinstance(model_or_payload, dict) else model_or_payload
+            loaded = self.ensure_loaded(model)
+            if loaded['cold']:
+                loads.append(loaded['load_seconds'])
+            return request_fn(model_or_payload)
+        return wrapped
+
+    def preload(self, model):
+        """Loads a model in a background thread (startup / model switch). Returns immediately."""
+        if not self.is_local(model):
+            return
+        with self._lock:
+            if model in self._loading:
+                return
+            self._loading.add(model)
+
+        def _run():
+            try:
+                self.ensure_loaded(model)
+            finally:
+                with self._lock:
+                    self._loading.discard(model)
+
+        threading.Thread(target=_run, name=f"preload-{model}", daemon=True).start()
+
+    def is_loading(self, model):
+        with self._lock:
+            return model in self._loading
+
+    def record_response(self, model, response):
+        """
+        Reads load_duration from an Ollama response to tell whether that request paid a cold load
+        (e.g. the model was evicted between ensure_loaded() and the request).
+        """
+        self.touch(model)
+        load_s = (response or {}).get('load_duration', 0) / 1e9
+        return {"cold": load_s > COLD_LOAD_THRESHOLD_S, "load_seconds": load_s}
@@ -0,0 +1,245 @@
+import io
+import os
+import json
+import time
+import statistics
+from collections import Counter
+
+from PIL import Image, ImageOps
+
+from history_store import iter_records, parse_seconds, is_complete, review_agrees
+
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+# Configuration
+OCR_TEXT_MODEL = os.getenv("OCR_TEXT_MODEL", "llama3.2")  # text-only model that audits the OCR text
+OCR_LANG = os.getenv("OCR_LANG", "eng")
+OCR_CONFIG = "--oem 1 --psm 4 -c preserve_interword_spaces=1"  # psm 4: one column of variable-size text
+OCR_MIN_CONFIDENCE = 75     # mean Tesseract word confidence (0-100); below this use the vision model
+OCR_MIN_WORDS = 20          # a receipt has at least this many words; fewer means OCR missed most of it
+OCR_TARGET_WIDTH = 1600     # narrower images are upscaled; Tesseract wants ~30px tall characters
+OCR_TEXT_NOTE = ("\nThe image itself is not attached. Below is its OCR text with the printed layout preserved "
+                 "(columns aligned with spaces). OCR can misread single characters; read amounts in context.\n\n")
+
+_available = None
+
+def ocr_available():
+    """True when pytesseract and the tesseract binary are both installed"""
+    global _available
+    if _available is None:
+        try:
+            _available = pytesseract is not None and bool(pytesseract.get_tesseract_version())
+        except (OSError, RuntimeError):  # TesseractNotFoundError is an OSError
+            _available = False
+    return _available
+
+def _prepare(source):
+    if isinstance(source, Image.Image):
+        img = source
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        img = Image.open(io.BytesIO(source))
+    else:
+        img = Image.open(source)
+    img = ImageOps.exif_transpose(img).convert("L")
+    if img.width < OCR_TARGET_WIDTH:
+        scale = OCR_TARGET_WIDTH / img.width
+        img = img.resize((OCR_TARGET_WIDTH, round(img.height * scale)), Image.LANCZOS)
+    return ImageOps.autocontrast(img)
+
+def layout_text(data):
+    """
+    Rebuilds text from Tesseract word boxes, placing each word at its column
+    (left edge / median character width) so item/qty/price columns stay aligned.
+    """
+    words = [
+        (data['block_num'][i], data['par_num'][i], data['line_num'][i], data['left'][i], data['width'][i], data['text'][i].strip())
+        for i in range(len(data['text'])) if data['text'][i].strip()
+    ]
+    if not words:
+        return ""
+    char_width = statistics.median(w / len(t) for _, _, _, _, w, t in words) or 1
+
+    lines, current_key, line = [], None, ""
+    for block, par, line_no, left, _, text in words:
+        if (block, par, line_no) != current_key:
+            if current_key is not None:
+                lines.append(line.rstrip())
+            current_key, line = (block, par, line_no), ""
+        col = round(left / char_width)
+        line += " " * (col - len(line)) if col > len(line) else (" " if line else "")
+        line += text
+    lines.append(line.rstrip())
+
+    # Drop the shared left margin
+    indent = min(len(l) - len(l.lstrip()) for l in lines if l.strip())
+    return "\n".join(l[indent:] for l in lines)
+
+def run_ocr(source):
+    """
+    Runs Tesseract on an image (bytes, path or PIL image).
+    Returns {"text", "confidence" (mean word confidence), "words", "low_confidence_words", "elapsed_ms"}.
+    """
+    t_start = time.time()
+    data = pytesseract.image_to_data(_prepare(source), lang=OCR_LANG, config=OCR_CONFIG,
+                                     output_type=pytesseract.Output.DICT)
+    confidences = [float(c) for c, t in zip(data['conf'], data['text']) if t.strip() and float(c) >= 0]
+    return {
+        "text": layout_text(data),
+        "confidence": round(statistics.mean(confidences), 1) if confidences else 0.0,
+        "words": len(confidences),
+        "low_confidence_words": sum(1 for c in confidences if c < 60),
+        "elapsed_ms": round((time.time() - t_start) * 1000, 1)
+    }
+
+def ocr_fallback_reason(ocr):
+    """Why the OCR text shouldn't be trusted (None if it's good enough for the text model)"""
+    if ocr['words'] < OCR_MIN_WORDS:
+        return f"too little text ({ocr['words']} words)"
+    if ocr['confidence'] < OCR_MIN_CONFIDENCE:
+        return f"low OCR confidence ({ocr['confidence']:.0f} < {OCR_MIN_CONFIDENCE})"
+    return None
+
+def text_user_prompt(prompt, ocr_text):
+    """The registered user prompt with the OCR text in place of the image"""
+    return prompt['user'] + OCR_TEXT_NOTE + ocr_text
+
+def pipeline_group(analysis):
+    """'ocr' (answered from OCR text), 'ocr_fallback' (OCR tried, vision answered) or 'vision'"""
+    pipeline = analysis.get('pipeline') or {}
+    if pipeline.get('mode') == "ocr":
+        return "ocr"
+    return "ocr_fallback" if pipeline.get('requested') == "ocr" else "vision"
+
+def pipeline_report(history_dir="receipt_history"):
+    """
+    Per-pipeline latency and accuracy over saved history, to decide per deployment
+    whether the OCR path is cheaper. Latency is the whole analysis call (OCR and any
+    fallback included); accuracy is field completeness, parse failures and agreement
+    with reviewer labels (analysis_result.review.conclusion) where present.
+    """
+    stats, reasons = {}, Counter()
+    for _, record in iter_records(history_dir):
+        analysis = record.get('analysis_result', {}) or {}
+        if analysis.get('tiling') or analysis.get('cascade'):
+            continue  # other pipelines; not comparable
+        group = pipeline_group(analysis)
+        s = stats.setdefault(group, {"n": 0, "latency": [], "prefill": [], "tokens": [], "ocr_ms": [],
+                                     "complete": 0, "unparsed": 0, "labelled": 0, "correct": 0})
+        s['n'] += 1
+        latency = parse_seconds((record.get('timings', {}) or {}).get('api_call_duration'))
+        if latency:
+            s['latency'].append(latency)
+        usage = record.get('usage_stats', {}) or {}
+        prefill = parse_seconds(usage.get('Prompt Eval'))
+        if prefill:
+            s['prefill'].append(prefill)
+        if usage.get('Prompt Tokens'):
+            s['tokens'].append(usage['Prompt Tokens'])
+        pipeline = analysis.get('pipeline') or {}
+        if (pipeline.get('ocr') or {}).get('elapsed_ms') is not None:
+            s['ocr_ms'].append(pipeline['ocr']['elapsed_ms'])
+        # Count the signal type only ("low OCR confidence (62 < 75)" -> "low OCR confidence")
+        reasons.update(r.split(' (')[0].split(':')[0] for r in pipeline.get('fallback_reasons', []))
+        if analysis.get('parse_error'):
+            s['unparsed'] += 1
+        elif is_complete(analysis.get('extracted_data', {}) or {}):
+            s['complete'] += 1
+        agrees = review_agrees(analysis)
+        if agrees is not None:
+            s['labelled'] += 1
+            s['correct'] += int(agrees)
+
+    median = lambda xs: round(statistics.median(xs), 2) if xs else None
+    report = {}
+    for group, s in sorted(stats.items()):
+        report[group] = {
+            "records": s['n'],
+            "median_latency_s": median(s['latency']),
+            "p90_latency_s": round(sorted(s['latency'])[int(0.9 * (len(s['latency']) - 1))], 2) if s['latency'] else None,
+            "median_prefill_s": median(s['prefill']),
+            "mean_prompt_tokens": round(statistics.mean(s['tokens'])) if s['tokens'] else None,
+            "median_ocr_ms": median(s['ocr_ms']),
+            "field_completeness": round(s['complete'] / s['n'], 3),
+            "parse_failure_rate": round(s['unparsed'] / s['n'], 3),
+            "label_accuracy": round(s['correct'] / s['labelled'], 3) if s['labelled'] else None,
+        }
+    attempted = sum(stats[g]['n'] for g in ("ocr", "ocr_fallback") if g in stats)
+    if attempted:
+        report['ocr_mode'] = {
+            "attempted": attempted,
+            "fallback_rate": round(stats.get('ocr_fallback', {}).get('n', 0) / attempted, 3),
+            "fallback_reasons": dict(reasons),
+            # What an OCR-mode deployment pays per receipt, fallbacks included
+            "median_latency_s": median(stats.get('ocr', {}).get('latency', []) + stats.get('ocr_fallback', {}).get('latency', [])),
+        }
+    return report
+
+def compare_paths(image_paths, text_model=OCR_TEXT_MODEL, vision_model=None, prompt_version=None):
+    """
+    Runs both paths on the same images (no fallback) and reports latency and
+    per-field agreement of the OCR path with the vision path.
+    """
+    import requests
+    from receipt_guard import (API_URL, MODEL_NAME, CASCADE_REQUIRED_FIELDS, build_payload, build_text_payload,
+                               encode_image, parse_model_output, derive_verdict)
+    from prompts import get_prompt, DEFAULT_PROMPT_VERSION
+
+    prompt = get_prompt(prompt_version or DEFAULT_PROMPT_VERSION)
+    vision_model = vision_model or MODEL_NAME
+    rows = []
+    for path in image_paths:
+        row = {"image": path}
+        t0 = time.time()
+        ocr = run_ocr(path)
+        t1 = time.time()
+        text = requests.post(API_URL, json=build_text_payload(ocr['text'], prompt, text_model)).json()
+        t2 = time.time()
+        vision = requests.post(API_URL, json=build_payload(encode_image(path), prompt, vision_model)).json()
+        t3 = time.time()
+        row.update({"ocr_confidence": ocr['confidence'], "ocr_s": round(t1 - t0, 2),
+                    "text_s": round(t2 - t1, 2), "vision_s": round(t3 - t2, 2)})
+        parsed = {}
+        for mode, response in (("ocr", text), ("vision", vision)):
+            try:
+                parsed[mode] = parse_model_output(response['message']['content'])[0]
+            except (KeyError, json.JSONDecodeError, ValueError):
+                parsed[mode] = None
+        ocr_fields = ((parsed['ocr'] or {}).get('extracted_data') or {})
+        vision_fields = ((parsed['vision'] or {}).get('extracted_data') or {})
+        row['fields_agree'] = {f: str(ocr_fields.get(f)).strip().lower() == str(vision_fields.get(f)).strip().lower()
+                               for f in CASCADE_REQUIRED_FIELDS}
+        row['verdicts'] = {"ocr": derive_verdict(parsed['ocr']), "vision": derive_verdict(parsed['vision'])}
+        rows.append(row)
+
+    n = len(rows) or 1
+    summary = {
+        "images": len(rows),
+        "median_ocr_path_s": round(statistics.median(r['ocr_s'] + r['text_s'] for r in rows), 2) if rows else None,
+        "median_vision_path_s": round(statistics.median(r['vision_s'] for r in rows), 2) if rows else None,
+        "field_agreement": {f: round(sum(r['fields_agree'][f] for r in rows) / n, 3) for f in CASCADE_REQUIRED_FIELDS},
+        "verdict_agreement": round(sum(r['verdicts']['ocr'] == r['verdicts']['vision'] for r in rows) / n, 3),
+    }
+    return summary, rows
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 2 and sys.argv[1] == "text":
+        ocr = run_ocr(sys.argv[2])
+        print(ocr['text'])
+        print(f"\n🔤 {ocr['words']} words, confidence {ocr['confidence']}, {ocr['elapsed_ms']} ms"
+              f" -> {ocr_fallback_reason(ocr) or 'OK for the text model'}")
+    elif len(sys.argv) > 2 and sys.argv[1] == "compare":
+        summary, rows = compare_paths(sys.argv[2:])
+        for r in rows:
+            print(f"   • {r['image']}: OCR {r['ocr_s'] + r['text_s']:.2f}s vs vision {r['vision_s']:.2f}s | "
+                  f"conf {r['ocr_confidence']} | verdicts {r['verdicts']['ocr']}/{r['verdicts']['vision']}")
+        print(json.dumps(summary, indent=2))
+    elif len(sys.argv) > 1 and sys.argv[1] == "report":
+        print(json.dumps(pipeline_report(), indent=2))
+    else:
+        print("Usage: python3 ocr_prepass.py text <image>          # show the OCR text sent to the text model")
+        print("       python3 ocr_prepass.py compare <images...>   # run both paths side by side")
+        print("       python3 ocr_prepass.py report                # per-pipeline latency/accuracy from history")
@@ -0,0 +1,300 @@
+import os
+import json
+import random
+import statistics
+
+from history_store import iter_records, parse_seconds, is_complete, review_agrees
+
+# Single source of truth for every prompt the app and CLI send.
+# Never edit a registered version in place: add a new key (e.g. "forensic-v2") so records stay comparable.
+
+FORENSIC_SYSTEM_PROMPT = """
+### SYSTEM RESET PROTOCOL
+You are a stateless auditor. You must IGNORE all previous receipt data, conversation history, or cached context. Analyze ONLY the image/text provided in this current transaction.
+
+### ROLE DEFINITION
+You are "Zhenyu + Yanzer Receipt AI," a specialized forensic document auditor and data extraction engine.
+**Your Mission:** Extract accurate receipt metadata AND detect fraud/tampering using strict Malaysian financial logic.
+
+---
+
+### PART 1: KNOWLEDGE BASE (THE 11 RULES OF MALAYSIAN RECEIPTS)
+To validate this receipt, you must apply these strict rules. If any rule is broken, you must flag it in the validation result.
+
+1.  **Subtotal:** Sum of all visible Line Items.
+2.  **Service Charge (10%):** This is a tip for the staff, NOT a government tax.
+    * *Calculation:* It is calculated on the **Subtotal**.
+3.  **SST (Service Tax - 6% or 8%):**
+    * *F&B Standard:* Restaurants typically charge **6%**.
+    * *Other Services:* Professional/Digital services may charge **8%**.
+    * *Calculation Rule:* SST is strictly calculated on the **Subtotal** (the taxable service amount). It is **NOT** calculated on the Service Charge.
+    * *Warning:* Do not flag a receipt as "Wrong Math" if the tax is lower than expected because it didn't tax the service charge.
+4.  **Tax Exemptions:** Basic food items (Rice, Cooking Oil) may be 0% Tax, while processed items are 6-10%. A mix is valid.
+5.  **Rounding Adjustment:** A final discrepancy of **+/- RM 0.04** is LEGALLY VALID in Malaysia (5-cent rounding mechanism).
+6.  **Set Meals:** Items priced RM 0.00 are valid if part of a Combo/Set.
+7.  **Void Items:** Ignore lines marked "Void" or "Cancel".
+8.  **Discounts:** Can apply to specific items or the full Subtotal.
+9.  **Deposits:** Differentiate "Grand Total" (Spend) from "Balance Due" (Payment).
+10. **Unit Logic:** `Qty` x `Unit Price` MUST equal `Line Total`.
+11. **Footer Noise:** Ignore Credit Card terminal numbers/Auth codes.
+
+---
+
+### PART 2: AUDIT PROTOCOL (THE "SCRATCHPAD" METHOD)
+*You must output this text block FIRST. Do not skip it. This is your "Working Memory".*
+
+**STEP 1: ITEM-BY-ITEM PRICE & MATH FORENSICS**
+Iterate through EVERY line item and output:
+* **Math Check:** Does `Qty` x `Price` = `Total`?
+* **Market Reason:** Does this specific price make sense in Malaysia?
+    * *Example:* "Teh O Ais at RM 150.00? -> REASON: Impossible, standard is RM 2-5."
+    * *Example:* "Wagyu Steak at RM 300.00? -> REASON: Plausible for premium beef."
+
+**STEP 2: TAX & TOTALS VERIFICATION (The "SST Logic Check")**
+* **Check Service Charge:** Is it 10% of Subtotal?
+* **Check SST:** Is it 6% (or 8%) of Subtotal?
+* **Final Math:** Subtotal + Svc Charge + SST +/- Rounding = Grand Total.
+* *Note:* If the math works but the rate is weird (e.g. 7%), flag as "SUSPICIOUS_TAX_RATE".
+
+**STEP 3: FRAUD VERDICT**
+* If Math fails > RM 0.05 diff (after rounding) => **FRAUD**.
+* If Price is impossible (e.g., RM 1000 Rice) => **FRAUD**.
+
+---
+
+### PART 3: DATA EXTRACTION INSTRUCTIONS
+After the analysis, extract these specific fields into the JSON:
+
+1.  **merchant_name**: Dominant business name on header.
+2.  **receipt_no**: Unique transaction ID (Invoice/Ref/Bill). Ignore Credit Card/App Codes.
+3.  **amount**: The final Grand Total (number with decimal).
+4.  **receipt_date**: Format YYYY-MM-DD.
+5.  **location**: Full merchant address.
+
+---
+
+### PART 4: FINAL OUTPUT FORMAT
+(Output the **AUDITOR SCRATCHPAD** text block first, then the **JSON** object).
+
+**Example Output Layout:**
+
+### AUDITOR SCRATCHPAD
+1. **Item Analysis:**
+   - [Item Name] | Qty: [x] | Unit: [Price] | Total: [LineTotal]
+     -> Math Status: [MATCH / FAIL]
+     -> Price Logic: [REASONING]
+   ...
+2. **Tax & Totals Review:**
+   - Subtotal: [RM xxx]
+   - Service Charge (10%): [RM xxx] (Calc on Subtotal)
+   - SST (6%): [RM xxx] (Calc on Subtotal)
+   - Rounding: [RM xxx]
+   - Expected Grand Total: [RM xxx] vs Printed: [RM xxx]
+3. **Verdict:** [VALID / FRAUD]
+
+```json
+{
+  "extracted_data": {
+    "merchant_name": "String",
+    "receipt_no": "String",
+    "amount": "String",
+    "receipt_date": "YYYY-MM-DD",
+    "location": "String"
+  },
+  "validation_result": {
+    "reasoning": "String",  // Summarize the Scratchpad findings here.
+    "conclusion": "String"  // "Yes" (if modified/fraud) OR "No" (if valid)
+  }
+}
+"""
+
+COMPACT_SYSTEM_PROMPT = """
+You are a stateless forensic receipt auditor for Malaysian receipts. Use ONLY the current receipt.
+
+Rules:
+1. Subtotal = sum of line items; Qty x Unit Price = Line Total.
+2. Service charge is 10% of Subtotal. SST is 6% (F&B) or 8% (other services) of Subtotal, never of the service charge.
+3. Rounding of +/- RM 0.04 is legal. RM 0.00 set/combo items are valid. Ignore Void/Cancel lines and card terminal/auth codes.
+4. Discounts may apply per item or on Subtotal. Grand Total (spend) is not Balance Due (payment).
+5. FRAUD if the totals are off by more than RM 0.05 after rounding, or a price is impossible for Malaysia (e.g. RM 150 Teh O Ais). An unusual tax rate (e.g. 7%) is SUSPICIOUS_TAX_RATE.
+
+Output a short AUDITOR SCRATCHPAD (each item with math MATCH/FAIL, then tax & totals check, then verdict VALID/FRAUD), then:
+```json
+{
+  "extracted_data": {
+    "merchant_name": "String",
+    "receipt_no": "String (invoice/bill no, not card codes)",
+    "amount": "String (grand total)",
+    "receipt_date": "YYYY-MM-DD",
+    "location": "String (full address)"
+  },
+  "validation_result": {
+    "reasoning": "String",
+    "conclusion": "Yes (fraud/modified) or No (valid)"
+  }
+}
+```
+"""
+
+TILE_PROMPT = """
+You are a receipt transcription engine. The image is ONE horizontal strip of a longer receipt.
+Neighbouring strips overlap, so transcribe every row you can read fully, including rows at the top and bottom edges.
+Do not guess rows that are cut off. Do not audit or judge the receipt.
+
+Output ONLY this JSON object (use null for anything not visible in this strip):
+```json
+{
+  "merchant_name": "String or null",
+  "receipt_no": "String or null",
+  "receipt_date": "YYYY-MM-DD or null",
+  "location": "String or null",
+  "line_items": [
+    {"name": "String", "qty": "String", "unit_price": "String", "line_total": "String"}
+  ],
+  "subtotal": "String or null",
+  "service_charge": "String or null",
+  "sst": "String or null",
+  "rounding": "String or null",
+  "grand_total": "String or null"
+}
+```
+"""
+
+CHAT_SYSTEM_PROMPT = "You are a helpful assistant analyzing a receipt. Be concise."
+
+PROMPTS = {
+    "forensic-v1": {
+        "description": "Full 11-rule forensic prompt with scratchpad (original)",
+        "system": FORENSIC_SYSTEM_PROMPT,
+        "user": "Analyze this receipt image according to your instructions.",
+        "temperature": 0.1,
+        "num_ctx": 4096,
+    },
+    "compact-v1": {
+        "description": "Same rules and JSON schema, condensed to cut prefill",
+        "system": COMPACT_SYSTEM_PROMPT,
+        "user": "Analyze this receipt image according to your instructions.",
+        "temperature": 0.1,
+        "num_ctx": 4096,
+    },
+}
+
+DEFAULT_PROMPT_VERSION = "forensic-v1"
+# A/B mode: (variant A, variant B)
+AB_VARIANTS = ("compact-v1", "forensic-v1")
+
+def get_prompt(version=DEFAULT_PROMPT_VERSION):
+    """Returns the registered prompt dict (system, user, temperature, num_ctx) with its version stamped in"""
+    if version not in PROMPTS:
+        raise KeyError(f"Unknown prompt version '{version}'. Registered: {', '.join(PROMPTS)}")
+    return dict(PROMPTS[version], version=version)
+
+def choose_prompt_version(mode=DEFAULT_PROMPT_VERSION, ab_ratio=0.5):
+    """
+    mode: a registered version, or "ab" to split traffic.
+    In A/B mode a request gets variant A with probability ab_ratio, otherwise variant B.
+    """
+    if mode == "ab":
+        return AB_VARIANTS[0] if random.random() < ab_ratio else AB_VARIANTS[1]
+    return mode
+
+def estimate_tokens(text):
+    """Rough token count (~4 chars per token for English + markdown)"""
+    return max(1, len(text) // 4)
+
+def measure_prompt_tokens(version, model, api_base=None):
+    """
+    Measured token count of a prompt version on a real Ollama model:
+    prefills system + user message and reads prompt_eval_count (chat template included).
+    """
+    import requests
+    api_base = api_base or os.getenv("OLLAMA_API_BASE", "http://localhost:11434")
+    prompt = get_prompt(version)
+    payload = {
+        "model": model,
+        "stream": False,
+        "messages": [
+            {"role": "system", "content": prompt['system']},
+            {"role": "user", "content": prompt['user']}
+        ],
+        "options": {"temperature": 0, "num_predict": 1, "num_ctx": prompt['num_ctx']}
+    }
+    res = requests.post(f"{api_base}/api/chat", json=payload)
+    res.raise_for_status()
+    return res.json().get('prompt_eval_count', 0)
+
+def ab_report(history_dir="receipt_history"):
+    """
+    Compares prompt versions over saved history.
+    Prefill = Ollama prompt_eval_duration (cloud models report 0 and are left out of the timing columns).
+    Accuracy is measured as field completeness, plus agreement with a reviewer label where a record
+    carries one under analysis_result.review.conclusion (set in the app or with history_store.py review).
+    Only plain single-pass vision records are compared: cascade, tiled and OCR-text records send
+    a different input or use another model, so their prefill and tokens aren't like for like.
+    """
+    stats = {}
+    for _, record in iter_records(history_dir):
+        analysis = record.get('analysis_result', {}) or {}
+        version = analysis.get('prompt_version')
+        if not version or analysis.get('cascade') or analysis.get('tiling') or analysis.get('pipeline'):
+            continue
+        s = stats.setdefault(version, {"n": 0, "prefill": [], "tokens": [], "complete": 0, "fraud": 0, "labelled": 0, "correct": 0})
+        s['n'] += 1
+        usage = record.get('usage_stats', {}) or {}
+        prefill = parse_seconds(usage.get('Prompt Eval'))
+        if prefill:
+            s['prefill'].append(prefill)
+        if usage.get('Prompt Tokens'):
+            s['tokens'].append(usage['Prompt Tokens'])
+        if is_complete(analysis.get('extracted_data', {}) or {}):
+            s['complete'] += 1
+        conclusion = str((analysis.get('validation_result', {}) or {}).get('conclusion', '')).lower()
+        if conclusion.startswith('yes'):
+            s['fraud'] += 1
+        agrees = review_agrees(analysis)
+        if agrees is not None:
+            s['labelled'] += 1
+            s['correct'] += int(agrees)
+
+    report = {}
+    for version, s in sorted(stats.items()):
+        report[version] = {
+            "records": s['n'],
+            "est_system_tokens": estimate_tokens(PROMPTS[version]['system']) if version in PROMPTS else None,
+            "mean_prompt_tokens": round(statistics.mean(s['tokens'])) if s['tokens'] else None,
+            "median_prefill_s": round(statistics.median(s['prefill']), 2) if s['prefill'] else None,
+            "mean_prefill_s": round(statistics.mean(s['prefill']), 2) if s['prefill'] else None,
+            "field_completeness": round(s['complete'] / s['n'], 3),
+            "fraud_rate": round(s['fraud'] / s['n'], 3),
+            "label_accuracy": round(s['correct'] / s['labelled'], 3) if s['labelled'] else None,
+        }
+
+    a, b = AB_VARIANTS
+    if a in report and b in report:
+        ra, rb = report[a], report[b]
+        diff = lambda k: round(ra[k] - rb[k], 3) if ra[k] is not None and rb[k] is not None else None
+        report['difference'] = {
+            f"{a} minus {b}": {
+                "median_prefill_s": diff('median_prefill_s'),
+                "mean_prompt_tokens": diff('mean_prompt_tokens'),
+                "field_completeness": diff('field_completeness'),
+                "fraud_rate": diff('fraud_rate'),
+                "label_accuracy": diff('label_accuracy'),
+            }
+        }
+    return report
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "tokens":
+        model = sys.argv[2] if len(sys.argv) > 2 else None
+        for version, p in PROMPTS.items():
+            line = f"{version:<14} est. {estimate_tokens(p['system']):>5} tokens"
+            if model:
+                line += f" | measured on {model}: {measure_prompt_tokens(version, model)} tokens"
+            print(f"{line}  - {p['description']}")
+    elif len(sys.argv) > 1 and sys.argv[1] == "report":
+        print(json.dumps(ab_report(), indent=2))
+    else:
+        print("Usage: python3 prompts.py tokens [ollama_model]")
+        print("       python3 prompts.py report")
@@ -2,190 +2,677 @@ import requests
 import json
 import re
 import base64
-import sys
 import os
+import io
+import time
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from receipt_image import ReceiptImage
+from image_preflight import preflight
+from model_manager import OllamaModelManager, OLLAMA_KEEP_ALIVE, OLLAMA_API_BASE
+from prompts import get_prompt, choose_prompt_version, DEFAULT_PROMPT_VERSION, TILE_PROMPT, PROMPTS
+from history_store import parse_amount, parse_seconds, iter_records
+from ocr_prepass import OCR_TEXT_MODEL, ocr_available, run_ocr, ocr_fallback_reason, text_user_prompt
 
 # Configuration
 # 'qwen2.5-vl:3b' is a state-of-the-art multimodal model optimized for OCR.
 # It uses approx 3.2GB RAM and significantly outperforms older vision models.
 MODEL_NAME = "qwen2.5-vl:3b" 
-API_URL = "http://localhost:11434/api/chat"
-
-SYSTEM_PROMPT = """
-### SYSTEM RESET PROTOCOL
-You are a stateless auditor. You must IGNORE all previous receipt data, conversation history, or cached context. Analyze ONLY the image/text provided in this current transaction.
-
-### ROLE DEFINITION
-You are "Zhenyu + Yanzer Receipt AI," a specialized forensic document auditor and data extraction engine.
-**Your Mission:** Extract accurate receipt metadata AND detect fraud/tampering using strict Malaysian financial logic.
-
----
-
-### PART 1: KNOWLEDGE BASE (THE 11 RULES OF MALAYSIAN RECEIPTS)
-To validate this receipt, you must apply these strict rules. If any rule is broken, you must flag it in the validation result.
-
-1.  **Subtotal:** Sum of all visible Line Items.
-2.  **Service Charge (10%):** This is a tip for the staff, NOT a government tax.
-    * *Calculation:* It is calculated on the **Subtotal**.
-3.  **SST (Service Tax - 6% or 8%):**
-    * *F&B Standard:* Restaurants typically charge **6%**.
-    * *Other Services:* Professional/Digital services may charge **8%**.
-    * *Calculation Rule:* SST is strictly calculated on the **Subtotal** (the taxable service amount). It is **NOT** calculated on the Service Charge.
-    * *Warning:* Do not flag a receipt as "Wrong Math" if the tax is lower than expected because it didn't tax the service charge.
-4.  **Tax Exemptions:** Basic food items (Rice, Cooking Oil) may be 0% Tax, while processed items are 6-10%. A mix is valid.
-5.  **Rounding Adjustment:** A final discrepancy of **+/- RM 0.04** is LEGALLY VALID in Malaysia (5-cent rounding mechanism).
-6.  **Set Meals:** Items priced RM 0.00 are valid if part of a Combo/Set.
-7.  **Void Items:** Ignore lines marked "Void" or "Cancel".
-8.  **Discounts:** Can apply to specific items or the full Subtotal.
-9.  **Deposits:** Differentiate "Grand Total" (Spend) from "Balance Due" (Payment).
-10. **Unit Logic:** `Qty` x `Unit Price` MUST equal `Line Total`.
-11. **Footer Noise:** Ignore Credit Card terminal numbers/Auth codes.
-
----
-
-### PART 2: AUDIT PROTOCOL (THE "SCRATCHPAD" METHOD)
-*You must output this text block FIRST. Do not skip it. This is your "Working Memory".*
-
-**STEP 1: ITEM-BY-ITEM PRICE & MATH FORENSICS**
-Iterate through EVERY line item and output:
-* **Math Check:** Does `Qty` x `Price` = `Total`?
-* **Market Reason:** Does this specific price make sense in Malaysia?
-    * *Example:* "Teh O Ais at RM 150.00? -> REASON: Impossible, standard is RM 2-5."
-    * *Example:* "Wagyu Steak at RM 300.00? -> REASON: Plausible for premium beef."
-
-**STEP 2: TAX & TOTALS VERIFICATION (The "SST Logic Check")**
-* **Check Service Charge:** Is it 10% of Subtotal?
-* **Check SST:** Is it 6% (or 8%) of Subtotal?
-* **Final Math:** Subtotal + Svc Charge + SST +/- Rounding = Grand Total.
-* *Note:* If the math works but the rate is weird (e.g. 7%), flag as "SUSPICIOUS_TAX_RATE".
-
-**STEP 3: FRAUD VERDICT**
-* If Math fails > RM 0.05 diff (after rounding) => **FRAUD**.
-* If Price is impossible (e.g., RM 1000 Rice) => **FRAUD**.
-
----
-
-### PART 3: DATA EXTRACTION INSTRUCTIONS
-After the analysis, extract these specific fields into the JSON:
-
-1.  **merchant_name**: Dominant business name on header.
-2.  **receipt_no**: Unique transaction ID (Invoice/Ref/Bill). Ignore Credit Card/App Codes.
-3.  **amount**: The final Grand Total (number with decimal).
-4.  **receipt_date**: Format YYYY-MM-DD.
-5.  **location**: Full merchant address.
-
----
-
-### PART 4: FINAL OUTPUT FORMAT
-(Output the **AUDITOR SCRATCHPAD** text block first, then the **JSON** object).
-
-**Example Output Layout:**
-
-### AUDITOR SCRATCHPAD
-1. **Item Analysis:**
-   - [Item Name] | Qty: [x] | Unit: [Price] | Total: [LineTotal]
-     -> Math Status: [MATCH / FAIL]
-     -> Price Logic: [REASONING]
-   ...
-2. **Tax & Totals Review:**
-   - Subtotal: [RM xxx]
-   - Service Charge (10%): [RM xxx] (Calc on Subtotal)
-   - SST (6%): [RM xxx] (Calc on Subtotal)
-   - Rounding: [RM xxx]
-   - Expected Grand Total: [RM xxx] vs Printed: [RM xxx]
-3. **Verdict:** [VALID / FRAUD]
-
-```json
-{
-  "extracted_data": {
-    "merchant_name": "String",
-    "receipt_no": "String",
-    "amount": "String",
-    "receipt_date": "YYYY-MM-DD",
-    "location": "String"
-  },
-  "validation_result": {
-    "reasoning": "String",  // Summarize the Scratchpad findings here.
-    "conclusion": "String"  // "Yes" (if modified/fraud) OR "No" (if valid)
-  }
-}
-"""
+API_URL = f"{OLLAMA_API_BASE}/api/chat"  # same server the model manager warms and evicts on
+
+# Tiling (for long receipts that would otherwise be downscaled past legibility)
+TILE_MIN_ASPECT = 2.0   # height/width ratio above which --tiles auto will split
+TILE_ASPECT = 1.0       # each strip is roughly square: height = width * TILE_ASPECT
+TILE_OVERLAP = 0.2      # fraction of a strip repeated in the next one so no row is cut in half
+TILE_MIN_HEIGHT = 512   # px; very narrow images would otherwise become dozens of slivers
+TILE_MAX_COUNT = 12     # strips are made taller rather than exceeding this many vision calls
+TILE_WORKERS = 4        # concurrent tile requests (Ollama serves up to OLLAMA_NUM_PARALLEL at once)
+TILE_RETRIES = 1        # extra attempts for a strip that timed out or came back unparseable
+
+# Cascade: cheap model first, escalate only when its answer can't be trusted
+CASCADE_FAST_MODEL = MODEL_NAME
+CASCADE_REQUIRED_FIELDS = ("merchant_name", "receipt_no", "amount", "receipt_date")
+LOW_CONFIDENCE_PCT = 70
+LOW_CONFIDENCE_PHRASES = ("low confidence", "not confident", "unclear", "illegible", "blurry",
+                          "cannot read", "unable to read", "hard to read", "not legible")
+
+# Prompts live in prompts.py; kept here for callers that import it from this module
+SYSTEM_PROMPT = get_prompt(DEFAULT_PROMPT_VERSION)['system']
 
 def encode_image(image_path):
-    """Encodes an image to base64 string"""
-    if not os.path.exists(image_path):
-        raise FileNotFoundError(f"Image not found at {image_path}")
-    
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+    """Encodes an image to base64 string (file is mmapped, not read into a second buffer)"""
+    with ReceiptImage.from_file(image_path) as image:
+        return image.to_base64()
 
-def analyze_receipt(image_path):
-    print(f"🔍 Analyzing Receipt: {image_path}")
-    print(f"🧠 Model: {MODEL_NAME} (Vision)")
-    
+def parse_model_output(content):
+    """
+    Splits a mixed scratchpad + JSON model response.
+    Returns (json_data, scratchpad); raises ValueError / json.JSONDecodeError if no JSON is found.
+    """
+    # Extract JSON
+    json_str = None
+    # Try markdown json block
+    match = re.search(r'```json\s*(\{.*?\})\s*```', content, re.DOTALL)
+    if match:
+        json_str = match.group(1)
+    else:
+        # Try finding first/last brace
+        s = content.find('{')
+        e = content.rfind('}')
+        if s != -1 and e != -1:
+            json_str = content[s:e+1]
+
+    if not json_str:
+        raise ValueError("Could not find valid JSON in response")
+
+    json_data = json.loads(json_str)
+    scratchpad = content.replace(json_str if match else "", "").replace("```json", "").replace("```", "").strip()
+    return json_data, scratchpad
+
+RESPONSE_METADATA_KEYS = ("model", "created_at", "done_reason", "prompt_eval_count", "eval_count",
+                          "total_duration", "load_duration", "prompt_eval_duration", "eval_duration")
+
+def raw_output_of(response):
+    """Verbatim model text + response metadata, stored with each record so it can be re-parsed later"""
+    response = response or {}
+    return {
+        "content": (response.get('message') or {}).get('content'),
+        "response_metadata": {k: response[k] for k in RESPONSE_METADATA_KEYS if k in response}
+    }
+
+def derive_verdict(analysis_json):
+    """Normalised verdict used to compare runs: FRAUD, VALID, UNKNOWN (no usable conclusion) or UNPARSED"""
+    if not isinstance(analysis_json, dict) or 'validation_result' not in analysis_json:
+        return "UNPARSED"
+    conclusion = str((analysis_json.get('validation_result') or {}).get('conclusion', '')).strip().lower()
+    if conclusion.startswith('yes') or 'fraud' in conclusion:
+        return "FRAUD"
+    if conclusion.startswith('no') or 'valid' in conclusion:
+        return "VALID"
+    return "UNKNOWN"
+
+def parse_confidence(reasoning):
+    """Confidence % stated in the reasoning ('90% confidence', 'confidence: 85%'), or None"""
+    text = str(reasoning or "")
+    match = (re.search(r'(\d{1,3})\s*%\s*confiden', text, re.IGNORECASE)
+             or re.search(r'confiden\w*\D{0,15}?(\d{1,3})\s*%', text, re.IGNORECASE))
+    return int(match.group(1)) if match else None
+
+def escalation_reasons(analysis_json, parse_error=None):
+    """Why a first-pass answer should go to the stronger model (empty list = accept it)"""
+    if parse_error or not isinstance(analysis_json, dict):
+        return [f"json_parse_failed: {parse_error}" if parse_error else "json_parse_failed"]
+
+    reasons = []
+    extracted = analysis_json.get('extracted_data', {}) or {}
+    missing = [f for f in CASCADE_REQUIRED_FIELDS if not str(extracted.get(f) or "").strip()
+               or str(extracted.get(f)).strip().lower() in ("string", "unknown", "n/a", "null")]
+    if missing:
+        reasons.append("missing_fields: " + ", ".join(missing))
+
+    validation = analysis_json.get('validation_result', {}) or {}
+    if str(validation.get('conclusion', '')).strip().lower().startswith('yes'):
+        reasons.append("fraud_suspected")
+
+    reasoning = str(validation.get('reasoning', ''))
+    confidence = parse_confidence(reasoning)
+    if confidence is not None and confidence < LOW_CONFIDENCE_PCT:
+        reasons.append(f"low_confidence: {confidence}%")
+    elif any(p in reasoning.lower() for p in LOW_CONFIDENCE_PHRASES):
+        reasons.append("low_confidence: hedged reasoning")
+    return reasons
+
+def _run_pass(request_fn, model):
+    t_start = time.time()
+    entry = {"model": model}
+    response, analysis_json, parse_error = None, None, None
     try:
-        base64_image = encode_image(image_path)
+        response = request_fn(model)
+        analysis_json, scratchpad = parse_model_output(response['message']['content'])
+        analysis_json['auditor_scratchpad'] = scratchpad
+    except (json.JSONDecodeError, ValueError) as e:
+        parse_error = str(e)
+    entry['latency'] = f"{time.time() - t_start:.2f}s"
+    if response:
+        entry['token_usage'] = {
+            "input": response.get('prompt_eval_count', 0),
+            "output": response.get('eval_count', 0)
+        }
+        entry['raw_output'] = raw_output_of(response)
+    if analysis_json:
+        for key in ('extracted_data', 'validation_result', 'auditor_scratchpad'):
+            entry[key] = analysis_json.get(key)
+    if parse_error:
+        entry['error'] = parse_error
+    return entry, response, analysis_json, parse_error
+
+def run_cascade(request_fn, fast_model, strong_model, log=print):
+    """
+    Runs fast_model first and escalates to strong_model only if escalation_reasons() finds a problem.
+    request_fn(model) must return an Ollama-shaped response dict.
+    Returns (final_response, final_analysis_json, cascade_info); final_analysis_json is None if no pass produced JSON.
+    """
+    passes, request_error = [], None
+    try:
+        first, response, analysis_json, parse_error = _run_pass(request_fn, fast_model)
+        reasons = escalation_reasons(analysis_json, parse_error)
+    except requests.exceptions.RequestException as e:
+        # e.g. the fast model isn't pulled (404): that's a reason to escalate, not to give up
+        request_error = e
+        first, response, analysis_json = {"model": fast_model, "error": str(e)}, None, None
+        reasons = [f"fast_model_error: {e}"]
+    first['escalation_reasons'] = reasons
+    passes.append(first)
+    log(f"⚡ First pass on {fast_model}: {first.get('latency', 'failed')}" + (f" - escalating ({'; '.join(reasons)})" if reasons else " - accepted"))
+
+    final = (response, analysis_json, fast_model)
+    if reasons and strong_model and strong_model != fast_model:
+        try:
+            second, response2, analysis_json2, parse_error2 = _run_pass(request_fn, strong_model)
+        except requests.exceptions.RequestException as e:
+            request_error = e
+            second, response2, analysis_json2 = {"model": strong_model, "error": str(e)}, None, None
+        passes.append(second)
+        log(f"🧠 Escalated pass on {strong_model}: {second.get('latency', 'failed')}")
+        if analysis_json2 or (response2 is not None and final[0] is None):
+            final = (response2, analysis_json2, strong_model)
+
+    if final[0] is None:
+        raise request_error  # no model answered at all
+
+    response, analysis_json, final_model = final
+
+    cascade_info = {
+        "fast_model": fast_model,
+        "strong_model": strong_model,
+        "escalated": len(passes) > 1,
+        "escalation_reasons": reasons,
+        "final_model": final_model,
+        "passes": passes
+    }
+    return response, analysis_json, cascade_info
+
+def cascade_stats(history_dir="receipt_history"):
+    """Escalation rate, reasons and per-pass latency over saved cascade records"""
+    total, escalated, reasons = 0, 0, Counter()
+    fast_latency, strong_latency = [], []
+    for _, record in iter_records(history_dir):
+        cascade = (record.get('analysis_result', {}) or {}).get('cascade')
+        if not cascade:
+            continue
+        total += 1
+        passes = cascade.get('passes', [])
+        if passes and parse_seconds(passes[0].get('latency')):
+            fast_latency.append(parse_seconds(passes[0]['latency']))
+        if cascade.get('escalated'):
+            escalated += 1
+            # Count the signal type only ("missing_fields: amount" -> "missing_fields")
+            reasons.update(r.split(':')[0] for r in cascade.get('escalation_reasons', []))
+            if len(passes) > 1 and parse_seconds(passes[1].get('latency')):
+                strong_latency.append(parse_seconds(passes[1]['latency']))
+    mean = lambda xs: round(sum(xs) / len(xs), 2) if xs else None
+    return {
+        "cascade_records": total,
+        "escalated": escalated,
+        "escalation_rate": round(escalated / total, 3) if total else None,
+        "reasons": dict(reasons),
+        "mean_fast_pass_s": mean(fast_latency),
+        "mean_escalated_pass_s": mean(strong_latency)
+    }
+
+def split_into_tiles(image_path, tile_aspect=TILE_ASPECT, overlap=TILE_OVERLAP):
+    """
+    Cuts a tall receipt into overlapping horizontal strips at full resolution.
+    Returns a list of dicts: {"index", "top", "bottom", "image_base64"}.
+    """
+    with Image.open(image_path) as img:
+        img = img.convert("RGB")
+        width, height = img.size
+        tile_h = max(TILE_MIN_HEIGHT, int(width * tile_aspect))
+        # Smallest strip height that covers the image in TILE_MAX_COUNT overlapping strips
+        tile_h = max(tile_h, -(-height // (1 + (TILE_MAX_COUNT - 1) * (1 - overlap))))
+        tile_h = int(min(tile_h, height))
+        step = max(1, int(tile_h * (1 - overlap)))
+
+        tops = list(range(0, max(height - tile_h, 0) + 1, step))
+        bottoms = [top + tile_h for top in tops]
+        remainder = height - bottoms[-1]
+        if remainder > tile_h * overlap:
+            tops.append(height - tile_h)  # last strip flush with the bottom edge
+            bottoms.append(height)
+        elif remainder > 0:
+            bottoms[-1] = height  # a few rows left: stretch the last strip instead of adding one that is all overlap
+
+        tiles = []
+        for i, (top, bottom) in enumerate(zip(tops, bottoms)):
+            buf = io.BytesIO()
+            img.crop((0, top, width, bottom)).save(buf, format="JPEG", quality=90)
+            tiles.append({
+                "index": i,
+                "top": top,
+                "bottom": bottom,
+                "image_base64": base64.b64encode(buf.getvalue()).decode('utf-8')
+            })
+        return tiles
+
+def needs_tiling(image_path, min_aspect=TILE_MIN_ASPECT):
+    """True if the receipt is tall enough that a single image would be downscaled too far"""
+    with Image.open(image_path) as img:
+        width, height = img.size
+    return width > 0 and height / width >= min_aspect
+
+def analyze_tile(tile, model=MODEL_NAME):
+    """Transcribes one strip. Never raises: failures come back as an 'error' entry so other tiles still merge."""
+    payload = {
+        "model": model,
+        "stream": False,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "messages": [
+            {"role": "system", "content": TILE_PROMPT},
+            {"role": "user", "content": "Transcribe this receipt strip.", "images": [tile['image_base64']]}
+        ],
+        "options": {"temperature": 0.0, "num_ctx": 4096}
+    }
+    t_start = time.time()
+    entry = {"index": tile['index'], "top": tile['top'], "bottom": tile['bottom']}
+    try:
+        response = requests.post(API_URL, json=payload)
+        response.raise_for_status()
+        result = response.json()
+        entry['data'], _ = parse_model_output(result['message']['content'])
+        entry['token_usage'] = {
+            "input": result.get('prompt_eval_count', 0),
+            "output": result.get('eval_count', 0)
+        }
     except Exception as e:
-        print(f"❌ Error: {e}")
-        return
+        entry['error'] = str(e)
+    entry['latency'] = f"{time.time() - t_start:.2f}s"
+    return entry
+
+def _item_key(item):
+    name = re.sub(r'[^0-9a-z]', '', str(item.get('name', '')).lower())
+    # Compare in cents: adjacent strips may read the same total as "2" and "2.00"
+    amount = parse_amount(item.get('line_total'))
+    total = int(round(amount * 100)) if amount is not None else None
+    return (name, total)
+
+def merge_tiles(tile_results):
+    """
+    Joins per-strip transcriptions top to bottom.
+    Rows inside the overlap show up at the tail of one strip and the head of the next;
+    the longest such run is dropped from the later strip. Only adjacent strips are
+    compared: after a missing strip there is no overlap to remove.
+    """
+    merged = {
+        "merchant_name": None, "receipt_no": None, "receipt_date": None, "location": None,
+        "line_items": [],
+        "subtotal": None, "service_charge": None, "sst": None, "rounding": None, "grand_total": None
+    }
+    duplicates_removed = 0
+    prev_index, prev_keys = None, []
+    for entry in sorted(tile_results, key=lambda t: t['index']):
+        data = entry.get('data')
+        if not isinstance(data, dict):
+            continue
+        if prev_index is None or entry['index'] != prev_index + 1:
+            prev_keys = []
+
+        # Header fields: first strip that has them wins
+        for field in ("merchant_name", "receipt_no", "receipt_date", "location"):
+            if merged[field] is None and data.get(field):
+                merged[field] = data[field]
+        # Totals sit at the bottom: last strip that has them wins
+        for field in ("subtotal", "service_charge", "sst", "rounding", "grand_total"):
+            if data.get(field):
+                merged[field] = data[field]
+
+        items = [i for i in (data.get('line_items') or []) if isinstance(i, dict)]
+        new_keys = [_item_key(i) for i in items]
+        overlap = 0
+        for n in range(min(len(prev_keys), len(new_keys)), 0, -1):
+            if prev_keys[-n:] == new_keys[:n]:
+                overlap = n
+                break
+        duplicates_removed += overlap
+        merged['line_items'].extend(items[overlap:])
+        prev_index, prev_keys = entry['index'], new_keys
+
+    merged['overlap_rows_removed'] = duplicates_removed
+    return merged
+
+def transcription_to_text(merged):
+    """Renders a merged transcription as plain receipt text for the audit pass"""
+    lines = []
+    for field in ("merchant_name", "location", "receipt_no", "receipt_date"):
+        if merged.get(field):
+            lines.append(f"{field}: {merged[field]}")
+    lines.append("")
+    for item in merged['line_items']:
+        lines.append(f"{item.get('name')} | Qty: {item.get('qty')} | Unit: {item.get('unit_price')} | Total: {item.get('line_total')}")
+    lines.append("")
+    for field in ("subtotal", "service_charge", "sst", "rounding", "grand_total"):
+        if merged.get(field):
+            lines.append(f"{field}: {merged[field]}")
+    return "\n".join(lines)
+
+def analyze_tiled(image_path, model=MODEL_NAME, workers=TILE_WORKERS, prompt_version=DEFAULT_PROMPT_VERSION):
+    """
+    Tiled pipeline for long receipts: transcribe strips concurrently, merge,
+    then run the normal audit prompt over the merged transcription. Failed strips are
+    retried; if any still fail, tiling_info.incomplete is set and the whole image is
+    audited in a single pass instead.
+    Returns (result, tiling_info) where result has the usual Ollama response shape.
+    """
+    t_start = time.time()
+    tiles = split_into_tiles(image_path)
+    print(f"✂️ Split into {len(tiles)} overlapping strips, processing {min(workers, len(tiles))} at a time...")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        tile_results = list(pool.map(lambda t: analyze_tile(t, model), tiles))
+        retried = []
+        for _ in range(TILE_RETRIES):
+            failed = [tiles[e['index']] for e in tile_results if 'error' in e]
+            if not failed:
+                break
+            print(f"🔁 Retrying {len(failed)} failed strip(s)...")
+            retried.extend(t['index'] for t in failed)
+            for entry in pool.map(lambda t: analyze_tile(t, model), failed):
+                tile_results[entry['index']] = entry
+
+    for entry in tile_results:
+        status = f"❌ {entry['error']}" if 'error' in entry else f"{len(entry['data'].get('line_items') or [])} rows"
+        print(f"   • Strip {entry['index'] + 1} (y={entry['top']}-{entry['bottom']}): {entry['latency']} - {status}")
+
+    prompt = get_prompt(prompt_version)
+    missing = [e['index'] for e in tile_results if not isinstance(e.get('data'), dict)]
+    tiling_info = {
+        "tiles": [{k: v for k, v in e.items() if k != 'data'} for e in tile_results],
+        "retried_strips": sorted(set(retried)),
+        "tiles_wall_time": f"{time.time() - t_start:.2f}s"
+    }
+    if missing:
+        # Rows lost with a strip make the subtotal disagree with the line items, which the
+        # audit reads as fraud: judge the whole image in one pass instead
+        print(f"⚠️ Strip(s) {', '.join(str(i + 1) for i in missing)} could not be transcribed; auditing the whole image instead")
+        t_audit = time.time()
+        result = _post_chat(build_payload(encode_image(image_path), prompt, model))
+        tiling_info.update({"incomplete": True, "missing_strips": missing, "fallback": "single_image",
+                            "audit_duration": f"{time.time() - t_audit:.2f}s"})
+        return result, tiling_info
+
+    merged = merge_tiles(tile_results)
+    t_tiles_end = time.time()
 
     payload = {
-        "model": MODEL_NAME,
+        "model": model,
+        "stream": False,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "messages": [
+            {"role": "system", "content": prompt['system']},
+            {
+                "role": "user",
+                "content": prompt['user'] + "\nIt was transcribed from the image strip by strip:\n\n" + transcription_to_text(merged)
+            }
+        ],
+        "options": {"temperature": prompt['temperature'], "num_ctx": prompt['num_ctx']}
+    }
+    response = requests.post(API_URL, json=payload)
+    response.raise_for_status()
+    result = response.json()
+
+    tiling_info.update({
+        "incomplete": False,
+        "line_items": merged['line_items'],
+        "overlap_rows_removed": merged['overlap_rows_removed'],
+        "audit_duration": f"{time.time() - t_tiles_end:.2f}s"
+    })
+    return result, tiling_info
+
+def build_payload(base64_image, prompt, model=MODEL_NAME):
+    """Ollama /api/chat payload for one receipt image and a registered prompt"""
+    return {
+        "model": model,
         # "format": "json", # Removed to allow Scratchpad
         "stream": False,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
         "messages": [
             {
                 "role": "system",
-                "content": SYSTEM_PROMPT
+                "content": prompt['system']
             },
             {
                 "role": "user",
-                "content": "Analyze this receipt image according to your instructions.",
+                "content": prompt['user'],
                 "images": [base64_image]
             }
         ],
         "options": {
-            "temperature": 0.2, # Low temperature for more analytical/precise results
-            "num_ctx": 4096     # Larger context window for complex receipts
+            "temperature": prompt['temperature'], # Low temperature for more analytical/precise results
+            "num_ctx": prompt['num_ctx']          # Larger context window for complex receipts
         }
     }
 
+def build_text_payload(ocr_text, prompt, model=OCR_TEXT_MODEL):
+    """Same audit prompt as build_payload, with the receipt's OCR text in place of the image"""
+    return {
+        "model": model,
+        "stream": False,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "messages": [
+            {"role": "system", "content": prompt['system']},
+            {"role": "user", "content": text_user_prompt(prompt, ocr_text)}
+        ],
+        "options": {"temperature": prompt['temperature'], "num_ctx": prompt['num_ctx']}
+    }
+
+def _post_chat(payload):
+    response = requests.post(API_URL, json=payload)
+    response.raise_for_status()
+    return response.json()
+
+def run_ocr_first(image_source, prompt, vision_fn, vision_model, text_fn=_post_chat, text_model=OCR_TEXT_MODEL, log=print):
+    """
+    OCR pipeline: Tesseract text -> text-only model with the same audit prompt.
+    Falls back to vision_fn(vision_model) when OCR is unavailable or not confident, or when the
+    text answer would be escalated by the cascade checks (OCR misreads surface as missing
+    fields or arithmetic "fraud"). text_fn(payload) must return an Ollama-shaped response.
+    Neither function is called before OCR has been judged, so a wrapper that loads the model
+    (OllamaModelManager.with_loading) only ever loads the one that is needed.
+    Returns (final_response, final_analysis_json, pipeline_info).
+    """
+    info = {"requested": "ocr", "mode": "vision", "text_model": text_model, "fallback_reasons": [], "passes": []}
+    if not ocr_available():
+        info['fallback_reasons'].append("ocr_unavailable")
+    else:
+        try:
+            ocr = run_ocr(image_source)
+        except Exception as e:
+            # TesseractError, an image Tesseract can't read, ... - the vision path still can
+            ocr, reason = None, f"ocr_error: {type(e).__name__}: {e}"
+        else:
+            info['ocr'] = {k: ocr[k] for k in ("confidence", "words", "low_confidence_words", "elapsed_ms", "text")}
+            log(f"🔤 OCR: {ocr['words']} words, confidence {ocr['confidence']} ({ocr['elapsed_ms']} ms)")
+            reason = ocr_fallback_reason(ocr)
+        if reason:
+            info['fallback_reasons'].append(reason)
+        else:
+            try:
+                entry, response, analysis_json, parse_error = _run_pass(
+                    lambda m: text_fn(build_text_payload(ocr['text'], prompt, m)), text_model)
+                reasons = escalation_reasons(analysis_json, parse_error)
+            except requests.exceptions.RequestException as e:
+                entry, reasons = {"model": text_model, "error": str(e)}, [f"text_model_error: {e}"]
+            entry['mode'] = "ocr"
+            info['passes'].append(entry)
+            log(f"📝 Text pass on {text_model}: {entry.get('latency', 'failed')}" + (" - accepted" if not reasons else ""))
+            if not reasons:
+                info['mode'] = "ocr"
+                return response, analysis_json, info
+            info['fallback_reasons'].extend(reasons)
+
+    log(f"👁️ Using vision model {vision_model} ({'; '.join(info['fallback_reasons'])})")
+    entry, response, analysis_json, _ = _run_pass(vision_fn, vision_model)
+    entry['mode'] = "vision"
+    info['passes'].append(entry)
+    return response, analysis_json, info
+
+def usage_stats_of(response):
+    """The usage_stats block stored with every history record (same keys the app shows)"""
+    return {
+        "Eval Duration": f"{response.get('eval_duration', 0)/1e9:.2f}s",
+        "Prompt Eval": f"{response.get('prompt_eval_duration', 0)/1e9:.2f}s",
+        "Total Duration": f"{response.get('total_duration', 0)/1e9:.2f}s",
+        "Load Duration": f"{response.get('load_duration', 0)/1e9:.2f}s",
+        "Prompt Tokens": response.get('prompt_eval_count', 0),
+        "Output Tokens": response.get('eval_count', 0),
+        "Model": response.get('model', 'unknown')
+    }
+
+def analyze_for_history(image_path, prompt_mode=DEFAULT_PROMPT_VERSION, tiles="off", model=MODEL_NAME, manager=None,
+                        pipeline="vision", text_model=OCR_TEXT_MODEL):
+    """
+    Non-interactive analysis that returns everything history_store.save_record() needs:
+    {"merchant", "image_base64", "analysis_result", "usage_stats", "timings", "raw_output"}.
+    Parse failures are returned (merchant "Unparsed", analysis_result.parse_error), not raised;
+    connection/HTTP errors are raised.
+    """
+    timings = {"start": time.strftime('%H:%M:%S')}
+    t_start = time.time()
+    prompt_version = choose_prompt_version(prompt_mode)
+    base64_image = encode_image(image_path)
+
+    manager = manager or OllamaModelManager()
+    # OCR mode loads the text or vision model only once it knows which one it needs
+    warm = {"cold": False, "load_seconds": 0.0, "evicted": []} if pipeline == "ocr" else manager.ensure_loaded(model)
+
+    t_api_start = time.time()
+    tiling_info, pipeline_info, final_model = None, None, model
+    extra_loads = []  # cold loads of the OCR-mode models
+    if pipeline == "ocr":
+        vision_fn = manager.with_loading(lambda m: _post_chat(build_payload(base64_image, get_prompt(prompt_version), m)), extra_loads)
+        result, _, pipeline_info = run_ocr_first(image_path, get_prompt(prompt_version), vision_fn, model,
+                                                 text_fn=manager.with_loading(_post_chat, extra_loads),
+                                                 text_model=text_model, log=lambda *_: None)
+        final_model = text_model if pipeline_info['mode'] == "ocr" else model
+    elif tiles == "on" or (tiles == "auto" and needs_tiling(image_path)):
+        result, tiling_info = analyze_tiled(image_path, model=model, prompt_version=prompt_version)
+    else:
+        result = _post_chat(build_payload(base64_image, get_prompt(prompt_version), model))
+    t_api_end = time.time()
+
+    # Same accounting as the app: a load inside the request is not inference time
+    in_request = manager.record_response(final_model, result)
+    in_request_load = (in_request['load_seconds'] if in_request['cold'] else 0.0) + sum(extra_loads)
+    timings['cold_start'] = warm['cold'] or in_request['cold'] or bool(extra_loads)
+    timings['cold_load_duration'] = f"{warm['load_seconds'] + in_request_load:.2f}s"
+    timings['api_call_duration'] = f"{t_api_end - t_api_start - in_request_load:.2f}s"
+
+    try:
+        analysis_json, scratchpad = parse_model_output(result['message']['content'])
+        analysis_json['auditor_scratchpad'] = scratchpad
+        merchant = (analysis_json.get('extracted_data') or {}).get('merchant_name') or 'Unknown'
+    except (json.JSONDecodeError, ValueError) as e:
+        analysis_json, merchant = {"parse_error": str(e)}, "Unparsed"
+    analysis_json['model_used'] = result.get('model', final_model)
+    analysis_json['prompt_version'] = prompt_version
+    analysis_json['token_usage'] = {
+        "input": result.get('prompt_eval_count', 0),
+        "output": result.get('eval_count', 0)
+    }
+    analysis_json['source_file'] = os.path.abspath(image_path)
+    if tiling_info:
+        analysis_json['tiling'] = tiling_info
+    if pipeline_info:
+        analysis_json['pipeline'] = pipeline_info
+
+    timings['end'] = time.strftime('%H:%M:%S')
+    timings['total_wall_time'] = f"{time.time() - t_start:.2f}s"
+    return {
+        "merchant": merchant,
+        "image_base64": base64_image,
+        "analysis_result": analysis_json,
+        "usage_stats": usage_stats_of(result),
+        "timings": timings,
+        "raw_output": raw_output_of(result)
+    }
+
+def analyze_receipt(image_path, tiles="off", prompt_mode=DEFAULT_PROMPT_VERSION, cascade_model=None,
+                    pipeline="vision", text_model=OCR_TEXT_MODEL, manager=None):
+    """
+    tiles: 'off' (single image), 'on' (always split) or 'auto' (split only tall receipts)
+    prompt_mode: a version from prompts.PROMPTS, or 'ab' to split between the A/B variants
+    cascade_model: if set, MODEL_NAME does a first pass and this model is used only on escalation
+    pipeline: 'ocr' sends Tesseract text to text_model first and falls back to MODEL_NAME's vision path
+    manager: share one OllamaModelManager across a batch so eviction follows actual use
+    """
+    prompt_version = choose_prompt_version(prompt_mode)
+    prompt = get_prompt(prompt_version)
+    print(f"🔍 Analyzing Receipt: {image_path}")
+    if pipeline == "ocr":
+        print(f"🧠 Model: {text_model} (OCR text), fallback {MODEL_NAME} (Vision) | Prompt: {prompt_version}")
+    else:
+        print(f"🧠 Model: {MODEL_NAME} (Vision) | Prompt: {prompt_version}")
+    
+    try:
+        base64_image = encode_image(image_path)
+        use_tiles = tiles == "on" or (tiles == "auto" and needs_tiling(image_path))
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return
+
+    payload = build_payload(base64_image, prompt)
+
     print("⏳ Sending to ReceiptGuard AI (this requires the 'llava-phi3' model)...")
+    manager = manager or OllamaModelManager()
     try:
-        response = requests.post(API_URL, json=payload)
-        response.raise_for_status()
-        
-        result = response.json()
+        # OCR mode loads the text or vision model only once it knows which one it needs
+        warm = {"cold": False, "load_seconds": 0.0, "evicted": []} if pipeline == "ocr" else manager.ensure_loaded(MODEL_NAME)
+        if warm['cold']:
+            print(f"🧊 Cold start: loading {MODEL_NAME} took {warm['load_seconds']:.2f}s")
+
+        tiling_info, cascade_info, pipeline_info = None, None, None
+        extra_loads = []  # cold loads of models picked mid-run (escalation / fallback)
+        request_fn = manager.with_loading(lambda model: _post_chat(dict(payload, model=model)), extra_loads)
+        if pipeline == "ocr":
+            result, _, pipeline_info = run_ocr_first(image_path, prompt, request_fn, MODEL_NAME,
+                                                     text_fn=manager.with_loading(_post_chat, extra_loads), text_model=text_model)
+        elif use_tiles:
+            result, tiling_info = analyze_tiled(image_path, prompt_version=prompt_version)
+        elif cascade_model:
+            result, _, cascade_info = run_cascade(request_fn, CASCADE_FAST_MODEL, cascade_model)
+        else:
+            response = requests.post(API_URL, json=payload)
+            response.raise_for_status()
+            result = response.json()
+
         content = result['message']['content']
         
         try:
-            # Parse Mixed JSON/Text
-            # Extract JSON
-            json_str = None
-            match = re.search(r'```json\s*(\{.*?\})\s*```', content, re.DOTALL)
-            if match:
-                json_str = match.group(1)
-            else:
-                 s = content.find('{')
-                 e = content.rfind('}')
-                 if s != -1 and e != -1:
-                     json_str = content[s:e+1]
-            
-            if not json_str:
-                raise ValueError("No JSON found")
-
-            json_data = json.loads(json_str)
-            scratchpad = content.replace(json_str if match else "", "").replace("```json", "").replace("```", "").strip()
+            json_data, scratchpad = parse_model_output(content)
 
             print("\n📝 AUDITOR SCRATCHPAD:")
             print(scratchpad)
 
             # INJECT METADATA
             json_data['model_used'] = result.get('model', MODEL_NAME)
+            json_data['prompt_version'] = prompt_version
             json_data['token_usage'] = {
                 "input": result.get('prompt_eval_count', 0),
                 "output": result.get('eval_count', 0)
             }
+            json_data['timings'] = {
+                "cold_start": warm['cold'] or bool(extra_loads),
+                "cold_load_duration": f"{warm['load_seconds'] + sum(extra_loads):.2f}s"
+            }
+            if tiling_info:
+                json_data['tiling'] = tiling_info
+            if cascade_info:
+                json_data['cascade'] = cascade_info
+            if pipeline_info:
+                json_data['pipeline'] = pipeline_info
+            json_data['raw_output'] = raw_output_of(result)
 
             print("\n✅ ANALYSIS COMPLETE:")
             print(json.dumps(json_data, indent=2))
@@ -196,9 +683,21 @@ def analyze_receipt(image_path):
                 json.dump(json_data, f, indent=2)
             print(f"\n💾 Saved result to: {output_file}")
             
-        except (json.JSONDecodeError, ValueError):
+        except (json.JSONDecodeError, ValueError) as e:
             print("\n⚠️ Warning: Model output was not valid JSON. Raw output:")
             print(content)
+
+            # Keep it anyway so a parser fix can be replayed without another inference
+            output_file = image_path + ".analysis.json"
+            with open(output_file, 'w') as f:
+                json.dump({
+                    "parse_error": str(e),
+                    "model_used": result.get('model', MODEL_NAME),
+                    "prompt_version": prompt_version,
+                    "pipeline": pipeline_info,
+                    "raw_output": raw_output_of(result)
+                }, f, indent=2)
+            print(f"\n💾 Saved raw output to: {output_file}")
             
     except requests.exceptions.ConnectionError:
         print("\n❌ Error: Could not connect to Ollama. Is it running?")
@@ -206,8 +705,56 @@ def analyze_receipt(image_path):
         print(f"\n❌ Error during API call: {e}")
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python3 receipt_guard.py <path_to_receipt_image>")
+    parser = argparse.ArgumentParser(
+        description="ReceiptGuard AI - receipt extraction and fraud check",
+        epilog="Example: python3 receipt_guard.py ./my_receipt.jpg --tiles auto"
+    )
+    parser.add_argument("images", nargs="*", help="path(s) to receipt image(s)")
+    parser.add_argument("--tiles", choices=["off", "on", "auto"], default="off",
+                        help="split long receipts into overlapping strips (auto: only if height/width >= %.1f)" % TILE_MIN_ASPECT)
+    parser.add_argument("--prompt", choices=list(PROMPTS) + ["ab"], default=DEFAULT_PROMPT_VERSION,
+                        help="prompt version from prompts.py, or 'ab' to split between the A/B variants")
+    parser.add_argument("--cascade", metavar="STRONG_MODEL",
+                        help=f"run {CASCADE_FAST_MODEL} first and escalate to STRONG_MODEL only on parse failure, "
+                             "missing fields, fraud verdict or low confidence")
+    parser.add_argument("--ocr", action="store_true",
+                        help="run local OCR first and audit the text with a text-only model; falls back to vision when OCR is weak")
+    parser.add_argument("--text-model", default=OCR_TEXT_MODEL, help="text-only model for --ocr (default: %(default)s)")
+    parser.add_argument("--skip-bad", action="store_true",
+                        help="run the local image quality check first and skip blurry/dark/blank/non-receipt images")
+    parser.add_argument("--watch", metavar="DIR", action="append",
+                        help="keep running and analyze images dropped into DIR (repeatable); see receipt_watch.py for all options")
+    args = parser.parse_args()
+    if args.ocr and args.cascade:
+        parser.error("--ocr and --cascade are alternative pipelines; pick one")
+    if args.tiles != "off" and (args.ocr or args.cascade):
+        parser.error("--tiles runs its own pipeline and can't be combined with --ocr or --cascade")
+    if args.watch and args.cascade:
+        parser.error("--watch doesn't support --cascade")
+    pipeline = "ocr" if args.ocr else "vision"
+
+    if args.watch:
+        import signal
+        from receipt_watch import ReceiptWatcher
+        daemon = ReceiptWatcher(args.watch, prompt_mode=args.prompt, tiles=args.tiles, skip_bad=args.skip_bad,
+                                pipeline=pipeline, text_model=args.text_model)
+        signal.signal(signal.SIGINT, daemon.request_stop)
+        signal.signal(signal.SIGTERM, daemon.request_stop)
+        daemon.run()
+    elif not args.images:
+        print("Usage: python3 receipt_guard.py <path_to_receipt_image> [more images...] [--tiles off|on|auto] [--ocr] [--skip-bad]")
         print("Example: python3 receipt_guard.py ./my_receipt.jpg")
     else:
-        analyze_receipt(sys.argv[1])
+        skipped = []
+        manager = OllamaModelManager()  # one LRU for the whole batch
+        for image_path in args.images:
+            if args.skip_bad:
+                check = preflight(image_path)
+                if not check['ok']:
+                    print(f"⏭️ Skipping {image_path}: {'; '.join(check['issues'])}")
+                    skipped.append(image_path)
+                    continue
+            analyze_receipt(image_path, tiles=args.tiles, prompt_mode=args.prompt, cascade_model=args.cascade,
+                            pipeline=pipeline, text_model=args.text_model, manager=manager)
+        if len(args.images) > 1:
+            print(f"\n📦 Batch done: {len(args.images) - len(skipped)} analyzed, {len(skipped)} skipped by image check")
@@ -0,0 +1,83 @@
+import os
+import mmap
+import base64
+
+# Largest receipt image we keep in a session (raw bytes). Phone photos are typically 2-6 MB.
+MAX_IMAGE_BYTES = 15 * 1024 * 1024
+
+class ReceiptImage:
+    """
+    Holds a receipt image as raw bytes (or a read-only mmap for files on disk).
+    Base64 is only produced by to_base64(), which callers invoke once per outbound request,
+    so a session never keeps both the raw and the ~1.33x larger base64 copy around.
+    """
+
+    def __init__(self, data, source=None, max_bytes=MAX_IMAGE_BYTES):
+        if len(data) > max_bytes:
+            raise ValueError(
+                f"Image is {len(data) / 1024 / 1024:.1f} MB, limit is {max_bytes / 1024 / 1024:.0f} MB"
+            )
+        self._data = data
+        self._file = None
+        self.source = source
+
+    @classmethod
+    def from_bytes(cls, data, source=None):
+        return cls(data, source=source)
+
+    @classmethod
+    def from_base64(cls, image_base64, source=None):
+        """Decodes once, e.g. when loading a history record"""
+        return cls(base64.b64decode(image_base64), source=source)
+
+    @classmethod
+    def from_file(cls, path):
+        """Maps the file read-only instead of reading it into memory"""
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Image not found at {path}")
+        f = open(path, "rb")
+        try:
+            if os.fstat(f.fileno()).st_size == 0:
+                data = b""
+            else:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            image = cls(data, source=path)
+        except Exception:
+            f.close()
+            raise
+        image._file = f
+        return image
+
+    @property
+    def raw(self):
+        """Zero-copy view of the image bytes"""
+        return memoryview(self._data)
+
+    @property
+    def nbytes(self):
+        """Bytes held in memory by this object (mmapped files are paged in by the OS on demand)"""
+        return 0 if isinstance(self._data, mmap.mmap) else len(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def to_bytes(self):
+        """Plain bytes for APIs that need them (no copy for in-memory images)"""
+        return self._data if isinstance(self._data, bytes) else bytes(self._data)
+
+    def to_base64(self):
+        """Wire encoding. Not cached: call once per outbound request and let it go afterwards."""
+        return base64.b64encode(self._data).decode('utf-8')
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,347 @@
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import argparse
+import threading
+from collections import deque
+from datetime import datetime
+
+from history_store import HISTORY_DIR, save_record
+from image_preflight import preflight
+from model_manager import OllamaModelManager
+from prompts import PROMPTS, DEFAULT_PROMPT_VERSION
+from receipt_guard import analyze_for_history, derive_verdict
+from ocr_prepass import OCR_TEXT_MODEL
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# Configuration
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+WATCH_STATE_PATH = os.path.join(HISTORY_DIR, "watch_state.jsonl")  # .jsonl so history globs never pick it up
+WATCH_WORKERS = 2         # concurrent analyses; Ollama on one box rarely gains beyond 2
+QUEUE_SIZE = 100          # ready files waiting for a worker; beyond this they stay pending
+SETTLE_SECONDS = 2.0      # size and mtime must be unchanged this long before a file is picked up
+POLL_INTERVAL = 1.0
+STATUS_INTERVAL = 10.0
+THROUGHPUT_WINDOW = 300   # seconds of completions used for the per-minute rate
+
+def is_receipt_image(path):
+    name = os.path.basename(path)
+    return not name.startswith(".") and name.lower().endswith(IMAGE_EXTENSIONS)
+
+def scan_dirs(dirs):
+    """Every candidate image currently in the watched folders (not recursive)"""
+    found = []
+    for d in dirs:
+        try:
+            with os.scandir(d) as entries:
+                found.extend(e.path for e in entries if e.is_file() and is_receipt_image(e.path))
+        except FileNotFoundError:
+            continue
+    return found
+
+def file_key(path):
+    """(size, mtime) identifies a version of a file; a replaced file is processed again"""
+    st = os.stat(path)
+    return st.st_size, st.st_mtime
+
+class WatchLedger:
+    """
+    Append-only JSONL log of what the daemon did with each file. On restart,
+    files recorded as done/skipped (same size and mtime) are not processed again;
+    failed ones are retried.
+    """
+
+    def __init__(self, path=WATCH_STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn last line after a crash
+                    self._entries[entry['path']] = entry
+
+    def is_processed(self, path, key):
+        entry = self._entries.get(path)
+        return bool(entry) and entry['status'] in ("done", "skipped") and (entry['size'], entry['mtime']) == key
+
+    def record(self, path, key, status, **extra):
+        entry = {"path": path, "size": key[0], "mtime": key[1], "status": status,
+                 "at": datetime.now().isoformat(timespec="seconds"), **extra}
+        with self._lock:
+            self._entries[path] = entry
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+class PollingWatcher:
+    """Fallback watcher: rescans the folders every POLL_INTERVAL seconds"""
+    name = "polling"
+
+    def __init__(self, dirs):
+        self.dirs = dirs
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, POLL_INTERVAL))
+        return scan_dirs(self.dirs)
+
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    """Reports files as they are closed after writing or moved into a watched folder"""
+    name = "inotify"
+
+    def __init__(self, dirs):
+        self._inotify = INotify()
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+        self._dirs = {self._inotify.add_watch(d, mask): d for d in dirs}
+
+    def wait(self, timeout):
+        events = self._inotify.read(timeout=int(timeout * 1000))
+        return [os.path.join(self._dirs[e.wd], e.name) for e in events
+                if e.wd in self._dirs and e.name and is_receipt_image(e.name)]
+
+    def close(self):
+        self._inotify.close()
+
+def make_watcher(dirs, force_poll=False):
+    if INotify is not None and not force_poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(dirs)
+        except OSError as e:
+            print(f"⚠️ inotify unavailable ({e}); falling back to polling")
+    return PollingWatcher(dirs)
+
+class ReceiptWatcher:
+    """
+    watcher -> debounce (pending) -> bounded queue -> worker threads -> history.
+    Files that are still being written stay pending until they settle; when the
+    queue is full, settled files wait in pending too, so memory stays bounded.
+    """
+
+    def __init__(self, dirs, workers=WATCH_WORKERS, queue_size=QUEUE_SIZE, settle=SETTLE_SECONDS,
+                 prompt_mode=DEFAULT_PROMPT_VERSION, tiles="off", skip_bad=False,
+                 force_poll=False, state_path=WATCH_STATE_PATH, status_interval=STATUS_INTERVAL,
+                 pipeline="vision", text_model=OCR_TEXT_MODEL):
+        self.dirs = [os.path.abspath(d) for d in dirs]
+        self.workers = workers
+        self.settle = settle
+        self.prompt_mode = prompt_mode
+        self.tiles = tiles
+        self.skip_bad = skip_bad
+        self.pipeline = pipeline
+        self.text_model = text_model
+        self.force_poll = force_poll
+        self.status_interval = status_interval
+        self.ledger = WatchLedger(state_path)
+        self.manager = OllamaModelManager()
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self._pending = {}      # path -> [key, stable_since]
+        self._claimed = set()   # queued or in flight
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._failed = {}       # path -> key that failed this run
+        self._in_flight = 0
+        self._done_times = deque()
+        self.counts = {"done": 0, "failed": 0, "skipped": 0}
+
+    # --- Intake ---
+
+    def offer(self, path):
+        """Registers a file seen by the watcher; it is queued once it has settled"""
+        path = os.path.abspath(path)
+        with self._lock:
+            if path in self._claimed or path in self._pending:
+                return
+        try:
+            key = file_key(path)
+        except FileNotFoundError:
+            return
+        if self.ledger.is_processed(path, key) or self._failed.get(path) == key:
+            return  # failures are retried on the next start, or when the file changes
+        with self._lock:
+            self._pending[path] = [key, time.time()]
+
+    def _promote_settled(self):
+        now = time.time()
+        for path, (key, since) in list(self._pending.items()):
+            try:
+                current = file_key(path)
+            except FileNotFoundError:
+                del self._pending[path]  # moved away or deleted before we got to it
+                continue
+            if current != key:
+                self._pending[path] = [current, now]
+                continue
+            if now - since < self.settle or now - key[1] < self.settle:
+                continue
+            with self._lock:
+                self._claimed.add(path)
+            try:
+                self.queue.put_nowait((path, key))
+            except queue.Full:
+                with self._lock:
+                    self._claimed.discard(path)
+                return  # backpressure: stays pending until a worker frees a slot
+            del self._pending[path]
+
+    # --- Workers ---
+
+    def process(self, path, key):
+        """Analyses one image and writes it to history like the app does"""
+        if self.skip_bad:
+            check = preflight(path)
+            if not check['ok']:
+                print(f"⏭️ Skipping {os.path.basename(path)}: {'; '.join(check['issues'])}")
+                self.ledger.record(path, key, "skipped", issues=check['issues'])
+                return "skipped"
+
+        result = analyze_for_history(path, prompt_mode=self.prompt_mode, tiles=self.tiles, manager=self.manager,
+                                     pipeline=self.pipeline, text_model=self.text_model)
+        # One writer at a time so two receipts from the same merchant can't claim the same file name
+        with self._save_lock:
+            record_path = save_record(
+                result['merchant'], result['image_base64'], result['analysis_result'], [],
+                result['usage_stats'], result['timings'], raw_output=result['raw_output']
+            )
+        verdict = derive_verdict(result['analysis_result'])
+        print(f"✅ {os.path.basename(path)} -> {os.path.basename(record_path)} ({verdict}, {result['timings']['total_wall_time']})")
+        self.ledger.record(path, key, "done", record=record_path, verdict=verdict)
+        return "done"
+
+    def _worker(self):
+        while not self.stop_event.is_set():
+            try:
+                path, key = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            with self._lock:
+                self._in_flight += 1
+            status = "failed"
+            try:
+                status = self.process(path, key)
+            except Exception as e:
+                # One bad file (HTTP error, Tesseract crash, decompression bomb, odd model output) must not stop the worker
+                error = f"{type(e).__name__}: {e}"
+                print(f"❌ {os.path.basename(path)}: {error}")
+                self._failed[path] = key
+                try:
+                    self.ledger.record(path, key, "failed", error=error)
+                except OSError as ledger_error:
+                    print(f"⚠️ Warning: Could not write watch ledger: {ledger_error}")
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                    self._claimed.discard(path)
+                    self.counts[status] += 1
+                    self._done_times.append(time.time())
+                self.queue.task_done()
+
+    # --- Status ---
+
+    def status_line(self):
+        now = time.time()
+        while self._done_times and now - self._done_times[0] > THROUGHPUT_WINDOW:
+            self._done_times.popleft()
+        window = min(THROUGHPUT_WINDOW, now - self._started)
+        per_min = len(self._done_times) * 60 / window if window > 0 else 0.0
+        backlog = self.queue.qsize() + len(self._pending)
+        line = (f"📊 done {self.counts['done']} | failed {self.counts['failed']} | skipped {self.counts['skipped']}"
+                f" | in flight {self._in_flight} | queued {self.queue.qsize()} | settling/waiting {len(self._pending)}"
+                f" | {per_min:.1f}/min")
+        if backlog and per_min > 0:
+            line += f" | backlog ~{backlog / per_min:.0f} min"
+        return line
+
+    # --- Lifecycle ---
+
+    def request_stop(self, signum=None, frame=None):
+        if not self.stop_event.is_set():
+            print(f"\n🛑 Stopping: finishing {self._in_flight} in-flight receipt(s); "
+                  f"{self.queue.qsize() + len(self._pending)} waiting will be picked up on next start")
+            self.stop_event.set()
+        else:
+            print("🛑 Second signal, exiting without waiting (unfinished files are retried on next start)")
+            os._exit(1)
+
+    def run(self):
+        for d in self.dirs + [HISTORY_DIR]:
+            os.makedirs(d, exist_ok=True)
+        watcher = make_watcher(self.dirs, self.force_poll)
+        self._started = time.time()
+        print(f"👀 Watching {', '.join(self.dirs)} ({watcher.name}, {self.workers} workers, queue {self.queue.maxsize})")
+
+        # Resume: anything already in the folders and not in the ledger is backlog
+        for path in scan_dirs(self.dirs):
+            self.offer(path)
+        if self._pending:
+            print(f"📥 {len(self._pending)} unprocessed file(s) found on start")
+
+        threads = [threading.Thread(target=self._worker, name=f"receipt-worker-{i}", daemon=True)
+                   for i in range(self.workers)]
+        for t in threads:
+            t.start()
+
+        last_status = time.time()
+        try:
+            while not self.stop_event.is_set():
+                for path in watcher.wait(timeout=POLL_INTERVAL):
+                    self.offer(path)
+                self._promote_settled()
+                if self.status_interval and time.time() - last_status >= self.status_interval:
+                    print(self.status_line())
+                    last_status = time.time()
+        finally:
+            self.stop_event.set()
+            watcher.close()
+            for t in threads:
+                t.join()
+            print(self.status_line())
+            print("👋 Watcher stopped")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="ReceiptGuard AI - watch folders and analyze receipt images as they arrive",
+        epilog="Example: python3 receipt_watch.py /srv/scans /srv/mail-drop --workers 2 --skip-bad"
+    )
+    parser.add_argument("dirs", nargs="+", help="folder(s) to watch")
+    parser.add_argument("--workers", type=int, default=WATCH_WORKERS, help="concurrent analyses (default: %(default)s)")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE, help="max settled files waiting for a worker (default: %(default)s)")
+    parser.add_argument("--settle", type=float, default=SETTLE_SECONDS,
+                        help="seconds a file must be unchanged before it is analyzed (default: %(default)s)")
+    parser.add_argument("--poll", action="store_true", help="poll instead of using inotify")
+    parser.add_argument("--skip-bad", action="store_true", help="skip images that fail the local image quality check")
+    parser.add_argument("--tiles", choices=["off", "on", "auto"], default="off", help="tiling mode, as in receipt_guard.py")
+    parser.add_argument("--prompt", choices=list(PROMPTS) + ["ab"], default=DEFAULT_PROMPT_VERSION,
+                        help="prompt version from prompts.py, or 'ab' to split between the A/B variants")
+    parser.add_argument("--ocr", action="store_true", help="OCR text to a text-only model first, vision as fallback")
+    parser.add_argument("--text-model", default=OCR_TEXT_MODEL, help="text-only model for --ocr (default: %(default)s)")
+    parser.add_argument("--state", default=WATCH_STATE_PATH, help="ledger of processed files (default: %(default)s)")
+    parser.add_argument("--status-interval", type=float, default=STATUS_INTERVAL,
+                        help="seconds between status lines, 0 to disable (default: %(default)s)")
+    args = parser.parse_args()
+    if args.ocr and args.tiles != "off":
+        parser.error("--tiles runs its own pipeline and can't be combined with --ocr")
+
+    daemon = ReceiptWatcher(
+        args.dirs, workers=args.workers, queue_size=args.queue_size, settle=args.settle,
+        prompt_mode=args.prompt, tiles=args.tiles, skip_bad=args.skip_bad,
+        force_poll=args.poll, state_path=args.state, status_interval=args.status_interval,
+        pipeline="ocr" if args.ocr else "vision", text_model=args.text_model
+    )
+    signal.signal(signal.SIGINT, daemon.request_stop)
+    signal.signal(signal.SIGTERM, daemon.request_stop)
+    daemon.run()
@@ -0,0 +1,120 @@
+import os
+import json
+import glob
+import argparse
+from datetime import datetime
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from history_store import HISTORY_DIR, index_record, index_path_for
+from receipt_guard import parse_model_output, derive_verdict, escalation_reasons
+
+# Fields replaced when a re-parse is applied; everything else (model, tokens, cascade, chat) is kept
+REPARSED_KEYS = ("extracted_data", "validation_result", "auditor_scratchpad")
+
+def replay_record(path):
+    """
+    Re-runs extraction and validation on a record's stored raw model output (no model call).
+    Returns a small summary dict; the re-parsed analysis is included only when something changed.
+    """
+    try:
+        with open(path, "r") as f:
+            record = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        return {"path": path, "status": "unreadable", "error": str(e)}
+
+    content = (record.get('raw_output') or {}).get('content')
+    if not content:
+        return {"path": path, "status": "no_raw_output"}
+
+    old = record.get('analysis_result') or {}
+    new, error = None, None
+    try:
+        new, scratchpad = parse_model_output(content)
+        new['auditor_scratchpad'] = scratchpad
+    except (json.JSONDecodeError, ValueError) as e:
+        error = str(e)
+
+    old_verdict, new_verdict = derive_verdict(old), derive_verdict(new)
+    old_fields = old.get('extracted_data') or {}
+    new_fields = (new or {}).get('extracted_data') or {}
+    changed_fields = sorted(k for k in set(old_fields) | set(new_fields) if old_fields.get(k) != new_fields.get(k))
+
+    result = {
+        "path": path,
+        "status": "changed" if old_verdict != new_verdict or changed_fields else "unchanged",
+        "old_verdict": old_verdict,
+        "new_verdict": new_verdict,
+        "changed_fields": changed_fields,
+        "issues": [r for r in escalation_reasons(new, error) if r != "fraud_suspected"],
+    }
+    if error:
+        result['error'] = error
+    if result['status'] == "changed" and new is not None:
+        result['analysis'] = {k: new.get(k) for k in REPARSED_KEYS}
+    return result
+
+def apply_result(result):
+    """Writes a re-parsed analysis back into its record and refreshes the index"""
+    with open(result['path'], "r") as f:
+        record = json.load(f)
+    analysis = record.get('analysis_result') or {}
+    analysis.pop('parse_error', None)
+    analysis.update(result['analysis'])
+    analysis['replayed_at'] = datetime.now().isoformat(timespec="seconds")
+    record['analysis_result'] = analysis
+    record['merchant'] = (analysis.get('extracted_data') or {}).get('merchant_name') or record.get('merchant')
+    with open(result['path'], "w") as f:
+        json.dump(record, f, indent=2)
+    # Refresh the index of the folder the record lives in, not the default one
+    index_record(result['path'], record, index_path_for(os.path.dirname(result['path'])))
+
+def replay_history(history_dir=HISTORY_DIR, workers=None, apply=False):
+    """Replays every record in parallel; returns (summary, results)"""
+    paths = sorted(glob.glob(os.path.join(history_dir, "*.json")))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(replay_record, paths, chunksize=16))
+
+    status = Counter(r['status'] for r in results)
+    transitions = Counter(
+        f"{r['old_verdict']} -> {r['new_verdict']}"
+        for r in results if r['status'] == "changed" and r['old_verdict'] != r['new_verdict']
+    )
+    if apply:
+        for r in results:
+            if r.get('analysis'):
+                apply_result(r)
+    summary = {
+        "records": len(results),
+        "status": dict(status),
+        "verdict_changes": dict(transitions),
+        "applied": sum(1 for r in results if r.get('analysis')) if apply else 0
+    }
+    return summary, results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-parse and re-validate stored model output without calling any model")
+    parser.add_argument("--history", default=HISTORY_DIR, help="history folder (default: %(default)s)")
+    parser.add_argument("--workers", type=int, help="parallel processes (default: CPU count)")
+    parser.add_argument("--apply", action="store_true", help="write re-parsed results back into changed records")
+    parser.add_argument("--report", help="write per-record results as JSON here")
+    args = parser.parse_args()
+
+    print(f"🔁 Replaying stored model output in {args.history} ...")
+    summary, results = replay_history(args.history, args.workers, args.apply)
+
+    for r in results:
+        if r['status'] != "changed":
+            continue
+        line = f"   • {os.path.basename(r['path'])}: {r['old_verdict']} -> {r['new_verdict']}"
+        if r['changed_fields']:
+            line += f" | fields: {', '.join(r['changed_fields'])}"
+        if r.get('error'):
+            line += f" | {r['error']}"
+        print(line)
+    print(json.dumps(summary, indent=2))
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump([{k: v for k, v in r.items() if k != 'analysis'} for r in results], f, indent=2)
+        print(f"💾 Report saved to {args.report}")